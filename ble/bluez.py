@@ -2,6 +2,12 @@
 
 import pydbus
 from coiot.dbus_node import DBusNode
+from ble.gatt_cache import GattCache
+
+OBJECT_MANAGER = 'org.freedesktop.DBus.ObjectManager'
+PROPERTIES = 'org.freedesktop.DBus.Properties'
+DEVICE = 'org.bluez.Device1'
+GATT_SERVICE = 'org.bluez.GattService1'
 
 
 class DBusBluez(DBusNode):
@@ -19,19 +25,126 @@ class DBusAdapter(DBusNode):
         return self.get_children('^dev_', DBusDevice,
                                  key=lambda n, d: d.proxy.Address)
 
+    def watch(self, changed):
+        """
+        Calls changed(address, device, connected) for each device of the
+        adapter, then each time a device appears, disappears, connects or
+        disconnects, as signalled by BlueZ: nothing is polled.
+        A device is reported connected once its services are resolved, and
+        again when its services change.
+        The signals are dispatched by the GLib main loop.
+        Returns the subscriptions, to be disconnected to stop watching.
+        """
+        index = {}
+        prefix = self.path + '/dev_'
+        manager = self.bus.get(self.service, '/')[OBJECT_MANAGER]
+
+        def connected(props):
+            return props.get('Connected', False) and \
+                props.get('ServicesResolved', False)
+
+        def added(path, interfaces):
+            if not path.startswith(prefix):
+                return
+            if '/' in path[len(prefix):]:
+                dpath = path[:path.index('/', len(prefix))]
+                if GATT_SERVICE in interfaces and dpath in index:
+                    # services added after the resolution: Service Changed
+                    a, d, props = index[dpath]
+                    if connected(props):
+                        d.gatt_cache.invalidate(a)
+                        changed(a, d, True)
+                return
+            if DEVICE not in interfaces or path in index:
+                return
+            props = dict(interfaces[DEVICE])
+            d = DBusDevice(self.bus, self.service, path)
+            # kept up to date, eg for the RSSI
+            d.properties = props
+            index[path] = props['Address'], d, props
+            changed(props['Address'], d, connected(props))
+
+        def removed(path, interfaces):
+            if DEVICE in interfaces and path in index:
+                a, d, props = index.pop(path)
+                changed(a, d, False)
+
+        def properties_changed(sender, path, iface, signal, params):
+            interface, changes, invalidated = params
+            if path not in index:
+                return
+            a, d, props = index[path]
+            was = connected(props)
+            props.update(changes)
+            if connected(props) != was:
+                changed(a, d, connected(props))
+
+        subscriptions = [
+            manager.InterfacesAdded.connect(added),
+            manager.InterfacesRemoved.connect(removed),
+            self.bus.subscribe(sender=self.service, iface=PROPERTIES,
+                               signal='PropertiesChanged', arg0=DEVICE,
+                               signal_fired=properties_changed),
+        ]
+        for path, interfaces in manager.GetManagedObjects().items():
+            if DEVICE in interfaces:
+                added(path, interfaces)
+        return subscriptions
+
 
 class DBusDevice(DBusNode):
+    """
+    The GATT tree is read from gatt_cache when possible, so that the
+    services are only introspected once per device. The cached paths are
+    relative to the device, which may be reached through another adapter.
+    """
+    gatt_cache = GattCache()
+
+    @property
+    def address(self):
+        return self.path.split('/')[-1][len('dev_'):].replace('_', ':')
+
+    def relative(self, path):
+        return path[len(self.path) + 1:]
+
+    def absolute(self, path):
+        return self.path + '/' + path
+
     @property
     def services(self):
-        return self.get_children('^service', DBusGattService,
-                                 key=lambda n, s: s.proxy.UUID)
+        tree = self.gatt_cache.get(self.address)
+        # the absolute paths of former caches are introspected again
+        if tree is not None and \
+                not any(p.startswith('/') for p, c in tree.values()):
+            return {
+                u: DBusGattService(self.bus, self.service, self.absolute(p), {
+                    cu: DBusGattCharacteristic(self.bus, self.service,
+                                               self.absolute(cp))
+                    for cu, cp in c.items()})
+                for u, (p, c) in tree.items()}
+
+        services = self.get_children('^service', DBusGattService,
+                                     key=lambda n, s: s.proxy.UUID)
+        self.gatt_cache.put(self.address, {
+            u: [self.relative(s.path),
+                {cu: self.relative(c.path)
+                 for cu, c in s.characteristics.items()}]
+            for u, s in services.items()})
+        return services
 
 
 class DBusGattService(DBusNode):
+    def __init__(self, bus, service, path=None, characteristics=None):
+        super().__init__(bus, service, path)
+        self.cached_characteristics = characteristics
+
     @property
     def characteristics(self):
-        return self.get_children('^char', DBusGattCharacteristic,
-                                 key=lambda n, c: c.proxy.UUID)
+        if self.cached_characteristics is None:
+            self.cached_characteristics = self.get_children(
+                '^char', DBusGattCharacteristic,
+                key=lambda n, c: c.proxy.UUID)
+        return self.cached_characteristics
 
 
 class DBusGattCharacteristic(DBusNode):
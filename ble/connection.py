@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import functools
+import logging
+import time
+
+log = logging.getLogger('BLE')
+
+
+class Peripheral:
+    def __init__(self, address):
+        self.address = address
+        # keep it connected
+        self.target = False
+        self.connected = False
+        # probed since it connected
+        self.ready = False
+        self.operations = collections.deque()
+        self.task = None
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def busy(self):
+        return self.task is not None and not self.task.done()
+
+
+class ConnectionManager:
+    """
+    Keeps the target peripherals connected and probed, and runs the
+    operations on the peripherals:
+    - the operations of a peripheral are queued and run one at a time, in
+    order, each cancelled after timeout seconds
+    - the operations of different peripherals run concurrently, at most
+    concurrency at once
+    - after a failure, a peripheral backs off exponentially, from backoff
+    to max_backoff seconds
+    so that a slow or failing peripheral only delays its own operations.
+    connect(address) and probe(address) are coroutine functions, raising
+    on failure. wakeup() is called once the operations of a peripheral are
+    done, for maintain() to be called again, and on_failure(address,
+    failures) after each failure.
+    All the methods must be called from the event loop, except add().
+    """
+    def __init__(self, connect, probe, wakeup=None, concurrency=4,
+                 timeout=20, backoff=1, max_backoff=300, on_failure=None):
+        self.connect = connect
+        self.probe = probe
+        self.wakeup = wakeup
+        self.on_failure = on_failure
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.peripherals = {}
+
+    def peripheral(self, address):
+        p = self.peripherals.get(address)
+        if p is None:
+            p = self.peripherals[address] = Peripheral(address)
+        return p
+
+    def add(self, address):
+        """
+        Adds a peripheral to the ones to keep connected.
+        """
+        self.peripheral(address).target = True
+
+    def remove(self, address):
+        """
+        Stops keeping a peripheral connected.
+        """
+        self.peripheral(address).target = False
+
+    def set_connected(self, address, connected):
+        p = self.peripheral(address)
+        p.connected = connected
+        p.ready = False
+        if connected:
+            p.failures = 0
+            p.retry_at = 0
+
+    def submit(self, address, operation):
+        """
+        Queues operation, a coroutine function without arguments, on the
+        peripheral.
+        """
+        p = self.peripheral(address)
+        p.operations.append(operation)
+        if not p.busy:
+            p.task = asyncio.get_running_loop().create_task(self.run(p))
+
+    def failed(self, p):
+        p.failures += 1
+        delay = min(self.backoff * 2 ** (p.failures - 1), self.max_backoff)
+        p.retry_at = time.monotonic() + delay
+        log.warning("{}: {} failures, retry in {}s".format(p.address,
+                                                           p.failures, delay))
+        if self.on_failure is not None:
+            self.on_failure(p.address, p.failures)
+
+    async def run(self, p):
+        while p.operations:
+            operation = p.operations.popleft()
+            delay = p.retry_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self.semaphore:
+                try:
+                    await asyncio.wait_for(operation(), self.timeout)
+                    p.failures = 0
+                except asyncio.TimeoutError:
+                    log.error("{}: operation timed out".format(p.address))
+                    self.failed(p)
+                except Exception as e:
+                    log.error("{}: {}".format(p.address, e))
+                    self.failed(p)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def maintain(self):
+        """
+        Connects the target peripherals that are not, and probes the
+        connected peripherals that are not probed yet.
+        """
+        now = time.monotonic()
+        for p in list(self.peripherals.values()):
+            if p.busy or now < p.retry_at:
+                continue
+            if not p.connected and p.target:
+                self.submit(p.address, functools.partial(self.connect_one, p))
+            elif p.connected and not p.ready:
+                self.submit(p.address, functools.partial(self.probe_one, p))
+
+    async def connect_one(self, p):
+        await self.connect(p.address)
+        # leave some time to the Connected signal
+        p.retry_at = time.monotonic() + self.backoff
+
+    async def probe_one(self, p):
+        await self.probe(p.address)
+        p.ready = p.connected
+
+    async def join(self):
+        """
+        Waits until all the queued operations are done.
+        """
+        tasks = [p.task for p in list(self.peripherals.values()) if p.busy]
+        while tasks:
+            await asyncio.gather(*tasks)
+            tasks = [p.task for p in list(self.peripherals.values())
+                     if p.busy]
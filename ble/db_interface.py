@@ -1,38 +1,55 @@
-from coiot.db import CoiotDBInterface, sqlite_cast
+from coiot.db import CoiotDBInterface, sqlite_cast, load_rows
+from ble.router import BLERouter
 import logging
 
 log = logging.getLogger('BLE')
 
 
 class BLEDriverParameters:
+    router = BLERouter()
+
     @classmethod
     def load(Cls, self):
         r = self.db.execute("""
-            SELECT ID, Mac, Idx
+            SELECT ID, Mac, Idx, Adapter
             FROM DRIVER_BLE
             WHERE Device = ?
             """, self.id).fetchone()
         if r is None:
             return False
-        self.__id, self.Mac, self.Idx = r
+        Cls.hydrate(self, *r)
         return True
 
     @classmethod
-    def install(Cls, self, Mac, Idx=None):
+    def load_many(Cls, db, devices):
+        return load_rows(devices, db.execute("""
+            SELECT Device, ID, Mac, Idx, Adapter
+            FROM DRIVER_BLE
+            """), Cls.hydrate)
+
+    @classmethod
+    def hydrate(Cls, self, iid, Mac, Idx, Adapter):
+        self.__id, self.Mac, self.Idx = iid, Mac, Idx
+        self.Adapter = Adapter
+
+    @classmethod
+    def install(Cls, self, Mac, Idx=None, Adapter=None):
         Mac = sqlite_cast(str, Mac)
         Idx = sqlite_cast(int, Idx)
+        Adapter = sqlite_cast(str, Adapter)
         r = self.db.execute("""
-            INSERT INTO DRIVER_BLE(Device, Mac, Idx)
-            VALUES(?, ?, ?)
-            """, self.id, Mac, Idx)
+            INSERT INTO DRIVER_BLE(Device, Mac, Idx, Adapter)
+            VALUES(?, ?, ?, ?)
+            """, self.id, Mac, Idx, Adapter)
         self.__id = r.lastrowid
         self.Mac = Mac
         self.Idx = Idx
+        self.Adapter = Adapter
 
     @property
     def driver(self):
-        if hasattr(BLEDriverParameters, 'driver'):
-            return BLEDriverParameters.driver
+        if BLEDriverParameters.router.drivers:
+            return BLEDriverParameters.router
         else:
             return None
 
@@ -42,4 +59,4 @@ class BLEDriverParameters:
 
     @classmethod
     def register_driver(Cls, driver):
-        Cls.driver = driver
+        Cls.router.add(driver)
@@ -1,9 +1,14 @@
 from . import gatt_uuid
 from gi.repository import GLib
 import logging
+import threading
 
 log = logging.getLogger('BLE')
 
+# Timeout of the D-Bus calls to the characteristics, in seconds: the calls
+# block a worker of the driver until they return
+CALL_TIMEOUT = 5
+
 drivers = []
 
 
@@ -38,28 +43,144 @@ class CompositeBleDevice:
     def __dir__(self):
         return [k for o in self.objects for k in dir(o)]
 
+    def close(self):
+        for o in self.objects:
+            if hasattr(o, 'close'):
+                o.close()
+
+    def stage(self, k, v):
+        """
+        Like setting k, but the objects supporting it only send the value
+        on flush().
+        """
+        for o in self.objects:
+            if k in dir(o):
+                if hasattr(o, 'stage'):
+                    return o.stage(k, v)
+                return setattr(o, k, v)
+
+    def flush(self):
+        for o in self.objects:
+            if hasattr(o, 'flush'):
+                o.flush()
+
 
 class BleAutomationIODigitalDevice:
     def __init__(self, ble_device, index):
         self.ble = ble_device
         self.index = index
+        # called with (key, value) when the device notifies a change
+        self.listener = None
 
     @property
     def On(self):
-        return self.ble.read(self.index)
+        return self.ble.get(self.index)
 
     @On.setter
     def On(self, value):
         return self.ble.write(value, self.index)
 
+    def stage(self, k, v):
+        if k == 'On':
+            self.ble.stage(v, self.index)
+        else:
+            setattr(self, k, v)
+
+    def flush(self):
+        self.ble.flush()
+
+    def notify(self, k, v):
+        if self.listener is not None:
+            self.listener(k, v)
+
+    def close(self):
+        self.ble.close()
+
 
 class BleAutomationIODigital:
+    """
+    When the characteristic supports notifications, the value is kept in a
+    local buffer, updated by the notifications, and the reads are served
+    from it: reading the gpios costs no round trip. The buffer is a tuple,
+    replaced as a whole, as it is updated from the GLib main loop and read
+    from the driver workers.
+    The staged gpio changes are sent together in a single full-value write,
+    without response when the characteristic allows it. Without
+    notifications, the value is read first, so that the write keeps the
+    gpios changed elsewhere since the last read. The changes are staged
+    from the event loop and flushed from the workers: flush() takes them
+    all at once, the ones staged meanwhile wait for the next flush().
+    """
     def __init__(self, characteristic):
         self.characteristic = characteristic
+        self.value = tuple(self.read())
         self.gpios = {i: BleAutomationIODigitalDevice(self, i)
-                      for i in range(0, len(self.read()))}
+                      for i in range(0, len(self.value))}
+        # offset -> value, written on flush()
+        self.staged = {}
+        self.staged_lock = threading.Lock()
         log.debug("{} gpios: {}".format(len(self.gpios),
                                         list(self.gpios.keys())))
+        self.subscription = None
+        if 'notify' in self.characteristic.Flags:
+            self.subscription = self.characteristic.PropertiesChanged \
+                .connect(self.properties_changed)
+            self.characteristic.StartNotify(timeout=CALL_TIMEOUT)
+
+    @property
+    def notifying(self):
+        return self.subscription is not None
+
+    def close(self):
+        if self.subscription is None:
+            return
+        self.subscription.disconnect()
+        self.subscription = None
+        try:
+            self.characteristic.StopNotify(timeout=CALL_TIMEOUT)
+        except GLib.Error as e:
+            # eg the device is already disconnected
+            log.debug('{} StopNotify: {}'.format(type(self).__name__,
+                                                 e.message))
+
+    def properties_changed(self, interface, changed, invalidated):
+        if 'Value' not in changed:
+            return
+        value = tuple(changed['Value'])
+        log.debug('{} notified {}'.format(type(self).__name__, value))
+        previous, self.value = self.value, value
+        for i, gpio in self.gpios.items():
+            if i < len(value) and (i >= len(previous) or
+                                   bool(value[i]) != bool(previous[i])):
+                gpio.notify('On', bool(value[i]))
+
+    def get(self, offset):
+        if self.notifying:
+            return bool(self.value[offset])
+        return self.read(offset)
+
+    def stage(self, value, offset):
+        with self.staged_lock:
+            self.staged[offset] = int(value)
+
+    def flush(self):
+        with self.staged_lock:
+            staged, self.staged = self.staged, {}
+        if not staged:
+            return
+        if self.notifying:
+            value = list(self.value)
+        else:
+            value = list(self.read())
+        for offset, v in staged.items():
+            value[offset] = v
+        p = {}
+        if 'write-without-response' in self.characteristic.Flags:
+            p['type'] = GLib.Variant('s', 'command')
+        log.info('{} start WriteValue'.format(type(self).__name__))
+        self.characteristic.WriteValue(value, p, timeout=CALL_TIMEOUT)
+        self.value = tuple(value)
+        log.info('{} WriteValue = {}'.format(type(self).__name__, value))
 
     @classmethod
     def readwrite_param(Cls, offset):
@@ -70,7 +191,8 @@ class BleAutomationIODigital:
 
     def read(self, offset=None):
         log.info('{} start ReadValue'.format(self.__class__.__name__))
-        r = self.characteristic.ReadValue(self.readwrite_param(offset))
+        r = self.characteristic.ReadValue(self.readwrite_param(offset),
+                                          timeout=CALL_TIMEOUT)
         log.info('{} ReadValue(offset={}) = {}'.format(self.__class__.__name__,
                                                        offset, r))
         if offset is not None:
@@ -83,7 +205,13 @@ class BleAutomationIODigital:
         if offset is not None:
             value = [int(value)]
         log.info('{} start WriteValue'.format(type(self).__name__))
-        self.characteristic.WriteValue(value, p)
+        self.characteristic.WriteValue(value, p, timeout=CALL_TIMEOUT)
+        if offset is not None:
+            buffer = list(self.value)
+            buffer[offset] = value[0]
+            self.value = tuple(buffer)
+        else:
+            self.value = tuple(value)
         log.info('{} WriteValue(offset={}) = {}'.format(type(self).__name__,
                                                         offset, value))
 
@@ -1,10 +1,12 @@
-import threading
-from coiot.device_action_list import DeviceActionList, DALDevice
+from coiot.device_action_list import DALDevice, USER
+from coiot.driver import Driver
+from ble.connection import ConnectionManager
 from ble.device import CompositeBleDevice, drivers as ble_drivers
 from gi.repository import GLib
 from . import db_interface
+import functools
 import logging
-import time
+import threading
 
 log = logging.getLogger('BLE')
 
@@ -12,74 +14,239 @@ log = logging.getLogger('BLE')
 db_interface.BLEDriverParameters.register()
 
 
-class BluezBLEDriver(threading.Thread):
-    def __init__(self, adapter, updates, autostart=True, drivers=ble_drivers):
-        super().__init__()
+class BluezBLEDriver(Driver):
+    """
+    Driver of the BLE devices of an adapter.
+    The devices are tracked from the BlueZ signals, and only probed when
+    they connect: the probe loop handles the changes signalled since its
+    last run. The connections manager keeps the registered devices
+    connected, and runs the probes and writes of the devices in parallel:
+    the probed devices (ble_devices, generations) are built apart and
+    swapped in or out under lock, and read under it.
+    """
+    probe_interval = 5
+    # gathers the actions of a scene into a single write per characteristic
+    batch_window = 0.02
+
+    def __init__(self, adapter, updates, autostart=True, drivers=ble_drivers,
+                 runtime=None, concurrency=4):
         self.adapter = adapter
         self.drivers = drivers
-        self.action_list = DeviceActionList()
         self.updates = updates
         self.cache = {}
         self.ble_devices = {}
+        # address -> GATT cache generation of the probed device
+        self.generations = {}
+        self.lock = threading.Lock()
+        # address -> (device, connected), changes not handled yet
+        self.changes = {}
+        # address -> DBusDevice, of the devices known by BlueZ
+        self.known = {}
+        self.connections = ConnectionManager(
+            self.connect_device, self.probe_device, self.request_probe,
+            concurrency, on_failure=self.connection_failed)
+        # a worker per concurrent operation, and one for the probe loop
+        self.workers = concurrency + 1
+        self.router = None
+        # actions staged since the last flush
+        self.staged = []
+        self.subscriptions = []
         db_interface.BLEDriverParameters.register_driver(self)
-        self.stopped = False
         self.adapter.proxy.Powered = True
-        if autostart:
-            self.start()
+        super().__init__(runtime, autostart)
+
+    def start(self):
+        super().start()
+        self.subscriptions = self.adapter.watch(self.device_changed)
 
     def stop(self):
-        self.stopped = True
+        for s in self.subscriptions:
+            s.disconnect()
+        self.subscriptions = []
+        if self.task is not None:
+            peripherals = list(self.connections.peripherals.values())
+            tasks = [p.task for p in peripherals if p.busy]
+            self.runtime.submit(self.runtime.cancel(tasks)).result()
+        super().stop()
+
+    def device_changed(self, a, d, connected):
+        self.runtime.loop.call_soon_threadsafe(self.changes.__setitem__,
+                                               a, (d, connected))
+        self.request_probe()
+
+    def update_device(self, a, d, connected):
+        """
+        Probes the device a when it connects or when its services change,
+        forgets it when it disconnects.
+        Returns False if BlueZ failed, so that it can be retried later.
+        """
+        devices = {}
+        try:
+            if not connected:
+                self.forget(a)
+                return True
+            generation = d.gatt_cache.generation(a)
+            with self.lock:
+                if a in self.ble_devices and \
+                        self.generations.get(a) == generation:
+                    return True
+            self.forget(a)
+            for driver in self.drivers:
+                driver_devices = driver.probe(d)
+                for i, v in driver_devices.items():
+                    v.listener = functools.partial(self.value_changed, a, i)
+                    devices.setdefault(i, CompositeBleDevice()).extend(v)
+            with self.lock:
+                self.generations[a] = generation
+                if devices:
+                    self.ble_devices[a] = devices
+        except GLib.Error as e:
+            epart = e.message.split(':')
+            if epart[0] != "GDBus.Error":
+                raise
+            if epart[1].startswith("org.freedesktop.DBus.Error.UnknownObject"):
+                # the GATT tree of the cache is stale
+                d.gatt_cache.invalidate(a)
+            elif not epart[1].startswith("org.bluez.Error"):
+                raise
+            emsg = ':'.join(epart[1:])
+            log.error("{}: {}".format(d, emsg))
+            for cd in devices.values():
+                cd.close()
+            self.forget(a)
+            return False
+        return True
+
+    def forget(self, a):
+        with self.lock:
+            devices = self.ble_devices.pop(a, {})
+        for cd in devices.values():
+            cd.close()
+
+    def ble_device(self, a, i):
+        """
+        Returns the probed device i of a, None if not probed.
+        """
+        with self.lock:
+            return self.ble_devices.get(a, {}).get(i)
+
+    def value_changed(self, a, i, k, v):
+        """
+        Called from the GLib main loop when a device notifies a change.
+        """
+        cd = self.cache.get(a, {}).get(i)
+        if cd is not None:
+            setattr(cd, k, v)
+            log.info("notify {}[{}] {} = {}".format(a, i, k, v))
 
     def refresh_devices(self):
+        """
+        Looks for all the devices of the adapter, for when the adapter
+        cannot be watched.
+        """
         for a, d in self.adapter.devices.items():
-            try:
-                if a in self.ble_devices:
-                    if not d.proxy.Connected:
-                        del self.ble_devices[a]
-                    else:
-                        continue
-
-                if not d.proxy.Connected:
-                    continue
-
-                for driver in self.drivers:
-                    driver_devices = driver.probe(d)
-                    for i, v in driver_devices.items():
-                        da = self.ble_devices.setdefault(a, {})
-                        da.setdefault(i, CompositeBleDevice()).extend(v)
-            except GLib.Error as e:
-                epart = e.message.split(':')
-                if epart[0] != "GDBus.Error":
-                    raise
-                if not epart[1].startswith("org.bluez.Error"):
-                    raise
-                emsg = ':'.join(epart[1:])
-                log.error("{}: {}".format(d, emsg))
-
-    def run(self):
-        while not self.stopped:
-            dkprev = set(self.ble_devices.keys())
-            self.refresh_devices()
-            for a in set(self.ble_devices.keys()).union(dkprev):
-                for cd in self.cache[a].values():
-                    cd.Online = (a in self.ble_devices.keys())
-
-            if not self.ble_devices:
-                time.sleep(1)
-                continue
-
-            t = self.action_list.pop()
-            if t is not None:
-                d, k, v = t
-                ble_dev = self.ble_devices[d.Mac][d.Idx]
-                setattr(ble_dev, k, v)
-                setattr(self.devices[d.Mac], k, v)
-                log.info("update {}[{}] {} = {}".format(d.Mac, d.Idx, k, v))
+            self.update_device(a, d, d.proxy.Connected)
 
-    def register(self, cache):
+    def set_online(self, a):
+        with self.lock:
+            online = a in self.ble_devices
+        for cd in self.cache.get(a, {}).values():
+            cd.Online = online
+
+    async def connect_device(self, a):
+        d = self.known.get(a)
+        if d is None:
+            raise ConnectionError("unknown to BlueZ")
+        log.info("connect {}".format(a))
+        # returns when the connection manager gives up
+        await self.call(d.proxy.Connect, timeout=self.connections.timeout)
+
+    async def probe_device(self, a):
+        ok = await self.call(self.update_device, a, self.known[a], True)
+        self.set_online(a)
+        if not ok:
+            raise ConnectionError("probe failed")
+
+    async def probe(self):
+        changes, self.changes = self.changes, {}
+        for a, (d, connected) in changes.items():
+            new = a not in self.known
+            self.known[a] = d
+            if new and self.router is not None:
+                self.router.discovered(self, a)
+            self.connections.set_connected(a, connected)
+            if not connected:
+                # after any probe in progress
+                self.connections.submit(a, functools.partial(
+                    self.forget_device, a))
+        self.connections.maintain()
+
+    async def forget_device(self, a):
+        # StopNotify is a blocking call
+        await self.call(self.forget, a)
+        self.set_online(a)
+
+    async def write(self, d, k, v):
+        cd = self.ble_device(d.Mac, d.Idx)
+        if cd is None:
+            log.warning("{}[{}] offline, drop {} = {}"
+                        .format(d.Mac, d.Idx, k, v))
+            return
+        cd.stage(k, v)
+        self.staged.append((d, k, v))
+
+    def flush_staged(self, staged):
+        # a characteristic is written by its first flush, the next ones
+        # have nothing left to write
+        for d, k, v in staged:
+            cd = self.ble_device(d.Mac, d.Idx)
+            if cd is not None:
+                cd.flush()
+
+    async def flush_device(self, staged):
+        await self.call(self.flush_staged, staged)
+        for d, k, v in staged:
+            setattr(self.cache[d.Mac][d.Idx], k, v)
+            log.info("update {}[{}] {} = {}".format(d.Mac, d.Idx, k, v))
+
+    async def flush(self):
+        """
+        Queues the staged writes on their devices, so that a slow device
+        does not delay the others.
+        """
+        staged, self.staged = self.staged, []
+        devices = {}
+        for d, k, v in staged:
+            devices.setdefault(d.Mac, []).append((d, k, v))
+        for a, device_staged in devices.items():
+            self.connections.submit(a, functools.partial(self.flush_device,
+                                                         device_staged))
+
+    @property
+    def name(self):
+        return str(self.adapter.path).split('/')[-1]
+
+    def connection_failed(self, a, failures):
+        if self.router is not None:
+            self.router.connection_failed(self, a, failures)
+
+    def attach(self, cache):
+        """
+        Makes the driver responsible of the device cache: the driver keeps
+        it connected and updates it.
+        """
+        self.connections.add(cache.Mac)
         da = self.cache.setdefault(cache.Mac, {})
         da[cache.Idx] = DALDevice(cache, self.updates)
-        return DALDevice(cache, self.action_list)
+        self.request_probe()
 
-    def __str__(self):
-        return type(self).__name__
+    def detach(self, a):
+        """
+        Releases the caches of the device a, and returns them.
+        """
+        self.connections.remove(a)
+        return [dal.device for dal in self.cache.pop(a, {}).values()]
+
+    def register(self, cache):
+        self.attach(cache)
+        return DALDevice(cache, self.action_list, USER)
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger('BLE')
+
+
+class GattCache:
+    """
+    Cache of the GATT tree of the BLE devices, by MAC address:
+    {service uuid: [service path, {characteristic uuid: path}]}, the paths
+    being relative to the device.
+    Each address has a generation, incremented when the services of the
+    device change: the tree is only valid for the generation it was
+    cached in.
+    The cache is saved to filename, if given, so that it survives restarts.
+    It is used from the driver workers and the GLib loop, under lock.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.devices = {}
+        self.lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.devices = json.load(f)
+            except ValueError as e:
+                log.error("{}: {}".format(filename, e))
+
+    def generation(self, mac):
+        with self.lock:
+            return self.devices.get(mac, {}).get('generation', 0)
+
+    def get(self, mac):
+        with self.lock:
+            entry = self.devices.get(mac, {})
+            if entry.get('cached') != entry.get('generation', 0):
+                return None
+            return entry['services']
+
+    def put(self, mac, services):
+        with self.lock:
+            entry = self.devices.setdefault(mac, {'generation': 0})
+            entry['cached'] = entry['generation']
+            entry['services'] = services
+            self.save()
+
+    def invalidate(self, mac):
+        with self.lock:
+            entry = self.devices.setdefault(mac, {'generation': 0})
+            entry['generation'] += 1
+            entry.pop('services', None)
+            log.info("{} GATT cache generation {}"
+                     .format(mac, entry['generation']))
+            self.save()
+
+    def save(self):
+        """
+        Saves the cache, called under lock.
+        """
+        if self.filename is None:
+            return
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(os.path.abspath(self.filename)),
+                prefix=os.path.basename(self.filename), suffix='.tmp',
+                delete=False) as f:
+            json.dump(self.devices, f)
+        os.replace(f.name, self.filename)
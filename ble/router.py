@@ -0,0 +1,123 @@
+from coiot.device_action_list import DALDevice, USER, SYNC
+import logging
+import threading
+
+log = logging.getLogger('BLE')
+
+
+class BLERouter:
+    """
+    Routes the BLE devices to the drivers, one driver per adapter:
+    - to the adapter of the device in the database (DRIVER_BLE.Adapter)
+    - else, once an adapter has seen the device, to the adapter seeing it
+    with the best RSSI, or with the fewest devices if no RSSI is known
+    A device that fails failover times in a row on its adapter is moved to
+    another adapter seeing it, unless its adapter is set in the database.
+    The actions on a device are forwarded to the driver it is routed to,
+    and dropped until it is routed.
+    The drivers call discovered() when they see a device for the first
+    time, from any thread.
+    """
+    failover = 3
+
+    def __init__(self):
+        # adapter name -> driver
+        self.drivers = {}
+        # mac -> adapter name
+        self.routes = {}
+        # macs whose adapter is set in the database
+        self.pinned = set()
+        # mac -> caches of the devices waiting for their first discovery
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, driver):
+        self.drivers[driver.name] = driver
+        driver.router = self
+
+    def load(self, driver):
+        return len(driver.cache)
+
+    def rssi(self, driver, mac):
+        d = driver.known.get(mac)
+        if d is None:
+            return None
+        return getattr(d, 'properties', {}).get('RSSI')
+
+    def choose(self, mac, exclude=()):
+        """
+        Returns the driver to route mac to, among the drivers seeing it,
+        None if there is none.
+        """
+        candidates = [d for n, d in self.drivers.items()
+                      if n not in exclude and mac in d.known]
+        if not candidates:
+            return None
+        seen = [(self.rssi(d, mac), d) for d in candidates
+                if self.rssi(d, mac) is not None]
+        if seen:
+            return max(seen, key=lambda s: s[0])[1]
+        return min(candidates, key=self.load)
+
+    def route(self, mac, driver):
+        self.routes[mac] = driver.name
+        log.info("{} routed to {}".format(mac, driver.name))
+
+    def register(self, cache):
+        with self.lock:
+            driver = None
+            if cache.Mac in self.routes:
+                driver = self.drivers[self.routes[cache.Mac]]
+            elif getattr(cache, 'Adapter', None) in self.drivers:
+                driver = self.drivers[cache.Adapter]
+                self.pinned.add(cache.Mac)
+                self.route(cache.Mac, driver)
+            else:
+                driver = self.choose(cache.Mac)
+                if driver is not None:
+                    self.route(cache.Mac, driver)
+            if driver is None:
+                log.info("{} not seen yet".format(cache.Mac))
+                self.pending.setdefault(cache.Mac, []).append(cache)
+            else:
+                driver.attach(cache)
+        return DALDevice(cache, self, USER)
+
+    def discovered(self, driver, mac):
+        """
+        Called by the drivers when they see mac for the first time.
+        """
+        with self.lock:
+            caches = self.pending.pop(mac, None)
+            if caches is None:
+                return
+            driver = self.choose(mac) or driver
+            self.route(mac, driver)
+        for cache in caches:
+            driver.attach(cache)
+
+    def set(self, d, k, v, priority=SYNC):
+        name = self.routes.get(d.Mac)
+        if name is None:
+            log.warning("{}[{}] not seen yet, drop {} = {}"
+                        .format(d.Mac, d.Idx, k, v))
+            return
+        self.drivers[name].action_list.set(d, k, v, priority)
+
+    def connection_failed(self, driver, mac, failures):
+        """
+        Called by the drivers when they fail to reach a device.
+        """
+        if mac in self.pinned or failures < self.failover:
+            return
+        with self.lock:
+            if self.routes.get(mac) != driver.name:
+                return
+            new = self.choose(mac, exclude=(driver.name,))
+            if new is None:
+                return
+            log.warning("{} fails on {}, moved to {}"
+                        .format(mac, driver.name, new.name))
+            self.routes[mac] = new.name
+        for cache in driver.detach(mac):
+            new.attach(cache)
@@ -1,11 +1,75 @@
 import sqlite3
 import logging
 from coiot.datetime import CoiotDatetime
+import array
+import functools
 import os
 import glob
+import itertools
+import re
+import sys
+import threading
+import urllib.parse
+import weakref
+import zipfile
 
 log = logging.getLogger('DB')
 
+sqlite3.register_adapter(CoiotDatetime, lambda d: d.epoch)
+
+# Number of normalized requests kept by statement()
+STATEMENTS = 1024
+# SQL string literals and quoted identifiers
+QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+@functools.lru_cache(maxsize=STATEMENTS)
+def statement(req):
+    """
+    Returns the normalized version of the SQL request req: runs of
+    whitespace outside of the quotes are collapsed, so that requests
+    differing only by their indentation share a single entry in the sqlite3
+    statement cache.
+    The last STATEMENTS requests are normalized once.
+    """
+    # split() puts the quoted parts at the odd indexes
+    parts = QUOTED.split(req)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+    return sys.intern(''.join(parts).strip())
+
+
+# Maximum number of measures returned by Sensor.SensorLog()
+SENSOR_LOG_POINTS = 1000
+# Maximum number of measures of a Sensor.SensorLogPage() page
+SENSOR_LOG_PAGE = 10000
+
+# Logs that can be exported by CoiotDB.export(): table, owner column, owner
+# table and value columns with their array typecode
+EXPORTS = {
+    'sensor': ('SENSOR_LOG', 'Sensor', 'SENSOR', (('Value', 'd'),)),
+    'switchable': ('SWITCHABLE_LOG', 'Switchable', 'SWITCHABLE',
+                   (('Value', 'b'),)),
+    'device_status': ('DEVICE_STATUS_LOG', 'Device', 'DEVICE',
+                      (('Online', 'b'), ('Error', 'b'))),
+}
+
+# Named statements of the hot paths, normalized at import
+SWITCHABLE_LOG_INSERT = statement("""
+    INSERT INTO SWITCHABLE_LOG(Date, Switchable, Value)
+    VALUES(?, ?, ?)
+    """)
+
+SENSOR_LOG_INSERT = statement("""
+    INSERT INTO SENSOR_LOG(Date, Sensor, Value)
+    VALUES(?, ?, ?)
+    """)
+
+DEVICE_STATUS_LOG_INSERT = statement("""
+    INSERT INTO DEVICE_STATUS_LOG(Device, Date, Online, Error)
+    VALUES(?, ?, ?, ?)
+    """)
+
 
 def sqlite_cast(vtype, v):
     """
@@ -35,7 +99,7 @@ def sqlite_cast(vtype, v):
         return str(v)
     elif vtype is CoiotDatetime:
         if type(v) in (float, int):
-            return CoiotDatetime.fromepoch(v)
+            return CoiotDatetime.from_epoch(v)
         elif v.lower() == 'now':
             return CoiotDatetime.now()
 
@@ -43,6 +107,21 @@ def sqlite_cast(vtype, v):
                     "casted to {}".format(type(v), vtype))
 
 
+def load_rows(devices, rows, hydrate):
+    """
+    Bulk version of an interface load(): calls hydrate(device, *fields) for
+    each (Device, *fields) row that belongs to one of the devices (a dict
+    ID: device), and returns the hydrated devices.
+    As with load(), only the first row of each device is used.
+    """
+    loaded = {}
+    for did, *fields in rows:
+        if did in devices and did not in loaded:
+            hydrate(devices[did], *fields)
+            loaded[did] = devices[did]
+    return loaded.values()
+
+
 class CoiotDBInterface:
     interfaces = set()
 
@@ -64,6 +143,23 @@ class CoiotDBInterface:
             device.load_interface(Interface)
         log.info('load {}'.format(device))
 
+    @classmethod
+    def load_many(Cls, db, devices):
+        """
+        Loads the interfaces of all the given devices (a dict ID: device).
+        Interfaces implementing load_many() read their table once for all
+        the devices, the others are loaded device per device.
+        """
+        for Interface in Cls.interfaces:
+            if hasattr(Interface, 'load_many'):
+                loaded = Interface.load_many(db, devices)
+            else:
+                loaded = [d for d in devices.values() if Interface.load(d)]
+            for device in loaded:
+                device.loaded_interface(Interface)
+        for device in devices.values():
+            log.info('load {}'.format(device))
+
     @classmethod
     def get(Cls, ifname):
         for Interface in Cls.interfaces:
@@ -87,11 +183,25 @@ class Displayable:
         if r is None:
             return False
 
-        self.__id, self.name, self.type = r
+        Cls.hydrate(self, *r)
+        return True
+
+    @classmethod
+    def load_many(Cls, db, devices):
+        return load_rows(devices, db.execute("""
+            SELECT Device, DISPLAYABLE.ID, DISPLAYABLE.Name,
+                   DISPLAYABLE_TYPE.Name
+            FROM DISPLAYABLE
+            LEFT JOIN DISPLAYABLE_TYPE
+            ON DISPLAYABLE_TYPE.ID = DISPLAYABLE.Type
+            """), Cls.hydrate)
+
+    @classmethod
+    def hydrate(Cls, self, iid, name, type):
+        self.__id, self.name, self.type = iid, name, type
 
         self.FutureName = self.name
         self.FutureType = self.type
-        return True
 
     @classmethod
     def install(Cls, self, Name, Type=None):
@@ -166,20 +276,31 @@ class Switchable:
         r = self.db.execute("""
             SELECT SWITCHABLE.ID, Value
             FROM SWITCHABLE
-            JOIN SWITCHABLE_LOG
-            ON SWITCHABLE.ID = SWITCHABLE_LOG.Switchable
+            JOIN SWITCHABLE_CURRENT
+            ON SWITCHABLE_CURRENT.Switchable = SWITCHABLE.ID
             WHERE Device = ?
-            GROUP BY SWITCHABLE.ID
-            LIMIT 1;
             """, self.id).fetchone()
 
         if r is None:
             return False
 
-        self.__id, self.on = r[0], bool(r[1])
-        self.FutureOn = self.on
+        Cls.hydrate(self, *r)
         return True
 
+    @classmethod
+    def load_many(Cls, db, devices):
+        return load_rows(devices, db.execute("""
+            SELECT Device, SWITCHABLE.ID, Value
+            FROM SWITCHABLE
+            JOIN SWITCHABLE_CURRENT
+            ON SWITCHABLE_CURRENT.Switchable = SWITCHABLE.ID
+            """), Cls.hydrate)
+
+    @classmethod
+    def hydrate(Cls, self, iid, on):
+        self.__id, self.on = iid, bool(on)
+        self.FutureOn = self.on
+
     @classmethod
     def install(Cls, self, On):
         On = sqlite_cast(bool, On)
@@ -203,10 +324,234 @@ class Switchable:
     def On(self, value):
         value = sqlite_cast(bool, value)
         self.on = value
+        self.db.log(SWITCHABLE_LOG_INSERT,
+                    CoiotDatetime.now(), self.__id, self.on)
+
+
+@CoiotDBInterface.declare
+class Sensor:
+    """
+    The measures are stored in the fundamental unit of the sensor unit (see
+    doc/database.md) and converted from and to the sensor unit and exponent
+    with factors computed once per sensor:
+        fundamental = value * to_fundamental[0] + to_fundamental[1]
+        value = fundamental * from_fundamental[0] + from_fundamental[1]
+    """
+    @classmethod
+    def load(Cls, self):
+        r = self.db.execute("""
+            SELECT SENSOR.ID, Exponent, UNIT.Name, Offset, Scale,
+                   SENSOR_CURRENT.Date, SENSOR_CURRENT.Value
+            FROM SENSOR
+            JOIN UNIT
+            ON UNIT.ID = SENSOR.Unit
+            LEFT JOIN UNIT_CONVERSION
+            ON UnitFrom = UNIT.Fundamental AND UnitTo = UNIT.ID
+            LEFT JOIN SENSOR_CURRENT
+            ON SENSOR_CURRENT.Sensor = SENSOR.ID
+            WHERE Device = ?
+            """, self.id).fetchone()
+
+        if r is None:
+            return False
+
+        Cls.hydrate(self, *r)
+        return True
+
+    @classmethod
+    def load_many(Cls, db, devices):
+        return load_rows(devices, db.execute("""
+            SELECT Device, SENSOR.ID, Exponent, UNIT.Name, Offset, Scale,
+                   SENSOR_CURRENT.Date, SENSOR_CURRENT.Value
+            FROM SENSOR
+            JOIN UNIT
+            ON UNIT.ID = SENSOR.Unit
+            LEFT JOIN UNIT_CONVERSION
+            ON UnitFrom = UNIT.Fundamental AND UnitTo = UNIT.ID
+            LEFT JOIN SENSOR_CURRENT
+            ON SENSOR_CURRENT.Sensor = SENSOR.ID
+            """), Cls.hydrate)
+
+    @classmethod
+    def hydrate(Cls, self, iid, exponent, unit, offset, scale,
+                date=None, measure=None):
+        self.__id = iid
+        self.exponent = exponent
+        self.unit = unit
+        self.__offset = offset if offset is not None else 0
+        self.__scale = scale if scale is not None else 1
+        self.measure = measure
+        self.measure_date = date
+        Cls.compute_factors(self)
+        self.FutureExponent = self.exponent
+
+    @classmethod
+    def compute_factors(Cls, self):
+        p = 10 ** self.exponent
+        self.to_fundamental = (p / self.__scale, -self.__offset / self.__scale)
+        self.from_fundamental = (self.__scale / p, self.__offset / p)
+
+    @classmethod
+    def install(Cls, self, Unit, Exponent=0):
+        Unit = sqlite_cast(str, Unit)
+        Exponent = sqlite_cast(int, Exponent)
+        r = self.db.execute("""
+            INSERT INTO SENSOR(Device, Exponent, Unit)
+            SELECT ?, ?, ID
+            FROM UNIT
+            WHERE Name = ?
+            """, self.id, Exponent, Unit)
+        if r.rowcount != 1:
+            raise Exception("Could not install the Sensor interface, "
+                            "have you specified a correct unit ?")
+        iid = r.lastrowid
+        r = self.db.execute("""
+            SELECT Offset, Scale
+            FROM UNIT
+            LEFT JOIN UNIT_CONVERSION
+            ON UnitFrom = UNIT.Fundamental AND UnitTo = UNIT.ID
+            WHERE UNIT.ID = (SELECT Unit FROM SENSOR WHERE ID = ?)
+            """, iid).fetchone()
+        Cls.hydrate(self, iid, Exponent, Unit, *r)
+
+    def record(self, samples):
+        """
+        Batched ingestion: logs the (date, value) samples, with dates as
+        epochs and values in the sensor unit and exponent (as Value).
+        The samples are written through the write-behind queue with a single
+        executemany().
+        """
+        a, b = self.to_fundamental
+        sid = self.__id
+        rows = [(date, sid, value * a + b) for date, value in samples]
+        if not rows:
+            return
+        self.db.log_many(SENSOR_LOG_INSERT, rows)
+        self.measure_date, _, self.measure = rows[-1]
+
+    @property
+    def Value(self):
+        if self.measure is None:
+            return 0
+        c, d = self.from_fundamental
+        return round(self.measure * c + d)
+
+    @Value.setter
+    def Value(self, value):
+        self.record(((CoiotDatetime.now().epoch, float(value)),))
+
+    @property
+    def Exponent(self):
+        return self.exponent
+
+    @Exponent.setter
+    def Exponent(self, value):
+        value = sqlite_cast(int, value)
+        self.exponent = value
+        Sensor.compute_factors(self)
         self.db.execute("""
-            INSERT INTO SWITCHABLE_LOG(Date, Switchable, Value)
-            VALUES(?, ?, ?)
-            """, CoiotDatetime.now(), self.__id, self.on)
+            UPDATE SENSOR
+            SET Exponent = ?
+            WHERE ID = ?
+            """, value, self.__id)
+
+    @property
+    def Unit(self):
+        return self.unit
+
+    @property
+    def MeasureDate(self):
+        if self.measure_date is None:
+            return 0.
+        return self.measure_date
+
+    def history(self, start, end, points=SENSOR_LOG_POINTS, closed=False):
+        """
+        Returns the measures from start to end (included if closed),
+        aggregated in at most points buckets of (date, min, max, avg, count),
+        with values in the sensor unit and exponent (as Value).
+        The buckets are read from the coarsest rollup whose resolution is
+        finer than the requested one, or from the raw log if there is none;
+        a coarser rollup is read when start is older than their retention.
+        """
+        resolution = max(end - start, 0) / points
+        before = '<=' if closed else '<'
+        levels = self.db.history_levels(start)
+        finer = [r for r in levels if r <= resolution]
+        level = finer[-1] if finer else levels[0]
+        if level:
+            rows = self.db.query("""
+                SELECT min(Bucket), min(Min), max(Max),
+                       sum(Sum) / sum(Count), sum(Count)
+                FROM SENSOR_ROLLUP
+                WHERE Sensor = ? AND Resolution = ?
+                AND Bucket > ? - Resolution AND Bucket {} ?
+                GROUP BY CAST((Bucket - ?) / ? AS INTEGER)
+                ORDER BY 1
+                """.format(before), self.__id, level, start, end, start,
+                resolution or 1)
+        else:
+            rows = self.db.query("""
+                SELECT min(Date), min(Value), max(Value), avg(Value), count(*)
+                FROM SENSOR_LOG
+                WHERE Sensor = ? AND Date >= ? AND Date {} ?
+                GROUP BY CAST((Date - ?) / ? AS INTEGER)
+                ORDER BY 1
+                """.format(before), self.__id, start, end, start,
+                resolution or 1)
+        c, d = self.from_fundamental
+        return [(date, vmin * c + d, vmax * c + d, avg * c + d, count)
+                for date, vmin, vmax, avg, count in rows]
+
+    def SensorLog(self, start, end):
+        return {date: round(avg)
+                for date, _, _, avg, _ in self.history(start, end,
+                                                       closed=True)}
+
+    def log_page(self, start, end, limit, cursor=''):
+        """
+        Returns a page of at most limit raw measures from start to end
+        (excluded), as a list of (date, value), and the cursor of the next
+        page ('' if this is the last one).
+        Pages are read with a keyset query on (Date, ID): the cursor is the
+        key of the last measure of the page.
+        """
+        limit = max(1, min(limit, SENSOR_LOG_PAGE))
+        if cursor:
+            date, iid = cursor.split(':')
+            key = (float(date), int(iid))
+        else:
+            key = (start, 0)
+        rows = self.db.query("""
+            SELECT Date, ID, Value
+            FROM SENSOR_LOG
+            WHERE Sensor = ? AND (Date, ID) > (?, ?) AND Date < ?
+            ORDER BY Date, ID
+            LIMIT ?
+            """, self.__id, key[0], key[1], end, limit).fetchall()
+        c, d = self.from_fundamental
+        page = [(date, round(measure * c + d)) for date, _, measure in rows]
+        if len(rows) < limit:
+            return page, ''
+        return page, '{!r}:{}'.format(rows[-1][0], rows[-1][1])
+
+    def iter_log(self, start, end, batch=SENSOR_LOG_PAGE):
+        """
+        Generator over the raw measures from start to end (excluded), read
+        batch by batch so that the memory stays bounded.
+        """
+        cursor = None
+        while cursor != '':
+            page, cursor = self.log_page(start, end, batch, cursor or '')
+            yield from page
+
+    def SensorLogPage(self, start, end, limit, cursor):
+        page, cursor = self.log_page(start, end, limit, cursor)
+        return dict(page), cursor
+
+    def SensorLogPacked(self, start, end, limit, cursor):
+        page, cursor = self.log_page(start, end, limit, cursor)
+        return [date for date, _ in page], [v for _, v in page], cursor
 
 
 def Composite():
@@ -228,8 +573,11 @@ def Composite():
     class CompositeCls(DefaultObject):
         def load_interface(self, Interface):
             if Interface.load(self):
-                add_interface(self, Interface)
-                log.info('loaded {} on {}'.format(Interface.__name__, self))
+                self.loaded_interface(Interface)
+
+        def loaded_interface(self, Interface):
+            add_interface(self, Interface)
+            log.info('loaded {} on {}'.format(Interface.__name__, self))
 
         def install_interface(self, Interface, *args, **kwargs):
             Interface.install(self, *args, **kwargs)
@@ -251,6 +599,8 @@ def CoiotDBDevice(*arg, **kw):
     * load() sets up the given object from the database and returns True iif
     this was succesful (ie the object implements the interface in database)
     * install() add database support for the given interface
+    Interfaces can also implement load_many(), the bulk version of load()
+    used when loading all the devices, see load_rows().
     See Switchable definition of these functions for more details.
 
     Any field implemented by the interface will be made available to the cache
@@ -262,7 +612,8 @@ def CoiotDBDevice(*arg, **kw):
     properties are not supported (this is a database after all).
     """
     class CoiotDBDevice(Composite()):
-        def __init__(self, db, did, pdid, last_online=None, Error=False):
+        def __init__(self, db, did, pdid, last_online=None, Error=False,
+                     load=True):
             self.db = db
             self.id = did
             self.pdid = pdid
@@ -272,27 +623,21 @@ def CoiotDBDevice(*arg, **kw):
             if last_online is None:
                 self.last_online = CoiotDatetime.from_epoch(self.db.execute("""
                     SELECT Date
-                    FROM DEVICE_STATUS_LOG
+                    FROM DEVICE_STATUS_CURRENT
                     WHERE Device = ?
-                    ORDER BY ID DESC
-                    LIMIT 1
                     """, self.id).fetchone()[0])
             else:
                 self.last_online = sqlite_cast(CoiotDatetime, last_online)
-            CoiotDBInterface.load_all(self)
+            if load:
+                CoiotDBInterface.load_all(self)
 
             def forbidden_attr(self, k, *args):
                 raise AttributeError(k)
             self.__setattr__ = forbidden_attr
 
         def log_status(self):
-            self.db.execute("""
-                            INSERT INTO DEVICE_STATUS_LOG(Device, Date,
-                                                          Online, Error)
-                            VALUES(?, ?, ?, ?)
-                            """,
-                            self.id, CoiotDatetime.now(),
-                            self.online, self.error)
+            self.db.log(DEVICE_STATUS_LOG_INSERT,
+                        self.id, CoiotDatetime.now(), self.online, self.error)
 
         @property
         def ID(self):
@@ -331,10 +676,145 @@ def CoiotDBDevice(*arg, **kw):
     return CoiotDBDevice(*arg, **kw)
 
 
+class CoiotDBWriteQueue:
+    """
+    Write-behind queue for the log inserts.
+
+    The inserts are kept in memory and committed together, in a single
+    transaction, when the queue is flushed. This happens when it holds batch
+    inserts, and at the latest delay seconds after the first pending insert
+    if a scheduler is set: scheduler(delay, callback) must call callback
+    once after delay seconds (eg a GLib timeout).
+    The delay is the durability window: with a delay of 0 the inserts are
+    written immediately.
+    """
+    def __init__(self, db, delay=0, batch=1000):
+        self.db = db
+        self.delay = delay
+        self.batch = batch
+        self.scheduler = None
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, req, args):
+        if self.delay <= 0:
+            self.flush()
+            self.db.execute(req, args)
+            return
+
+        self.push_many(req, (args,))
+
+    def push_many(self, req, rows):
+        empty = not self.pending
+        self.pending.extend((req, args) for args in rows)
+        if self.delay <= 0 or len(self.pending) >= self.batch:
+            self.flush()
+        elif empty and self.pending and self.scheduler is not None:
+            self.scheduler(self.delay, self.flush)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        log.debug("commit {} log entries".format(len(pending)))
+        self.db.execute("BEGIN")
+        try:
+            for req, rows in itertools.groupby(pending, key=lambda p: p[0]):
+                self.db.executemany(req, (args for _, args in rows))
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+
+class ThreadReader:
+    """
+    Read-only connection of a thread, kept in its thread-local storage: the
+    connection is closed once the thread ends.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class CoiotDBConnections:
+    """
+    Connections to a database file: a single writer connection, owned by
+    the thread that created it, and a read-only connection per reading
+    thread, closed when the thread ends.
+    In WAL mode, readers never block the writer nor the other way round;
+    synchronous=NORMAL is then safe and only syncs at checkpoints.
+    cache_size is in KiB and mmap_size in bytes, None keeps the SQLite
+    defaults.
+    """
+    cached_statements = 256
+
+    def __init__(self, filename, wal=True, cache_size=None, mmap_size=None):
+        self.filename = filename
+        self.pragmas = []
+        if cache_size is not None:
+            self.pragmas.append("PRAGMA cache_size=-{}"
+                                .format(int(cache_size)))
+        if mmap_size is not None:
+            self.pragmas.append("PRAGMA mmap_size={}".format(int(mmap_size)))
+        self.thread = threading.get_ident()
+        # finalizers closing the connections of the reading threads
+        self.finalizers = []
+        self.local = threading.local()
+
+        self.writer = self.connect(filename)
+        self.writer.isolation_level = None
+        if wal:
+            self.writer.execute("PRAGMA journal_mode=WAL")
+            self.writer.execute("PRAGMA synchronous=NORMAL")
+
+    def connect(self, *args, **kwargs):
+        c = sqlite3.connect(*args, cached_statements=self.cached_statements,
+                            **kwargs)
+        for pragma in self.pragmas:
+            c.execute(pragma)
+        return c
+
+    @property
+    def reader(self):
+        """
+        Read-only connection of the calling thread
+        """
+        if not hasattr(self.local, 'reader'):
+            path = urllib.parse.quote(os.path.abspath(self.filename))
+            c = self.connect('file:{}?mode=ro'.format(path), uri=True,
+                             check_same_thread=False)
+            self.local.reader = ThreadReader(c)
+            self.finalizers = [f for f in self.finalizers if f.alive]
+            self.finalizers.append(weakref.finalize(self.local.reader,
+                                                    c.close))
+        return self.local.reader.connection
+
+    @property
+    def readers(self):
+        """
+        Read-only connections of the live threads
+        """
+        return [p[0].connection for p in (f.peek() for f in self.finalizers)
+                if p is not None]
+
+    def is_writer(self):
+        return threading.get_ident() == self.thread
+
+    def close(self):
+        for f in self.finalizers:
+            f()
+        self.writer.close()
+
+
 class CoiotDB:
-    def __init__(self, filename):
-        self.db = sqlite3.connect(filename)
-        self.db.isolation_level = None
+    def __init__(self, filename, write_delay=0, write_batch=1000,
+                 wal=True, cache_size=None, mmap_size=None):
+        self.connections = CoiotDBConnections(filename, wal,
+                                              cache_size, mmap_size)
+        self.db = self.connections.writer
+        self.writes = CoiotDBWriteQueue(self.db, write_delay, write_batch)
         version = next(iter(self.db.execute("PRAGMA USER_VERSION")))[0]
         if version == 0:
             log.info("create database {}".format(filename))
@@ -347,19 +827,28 @@ class CoiotDB:
                 with open(f, 'r') as fd:
                     self.db.executescript(fd.read())
             self.db.execute("PRAGMA USER_VERSION={}".format(v))
+        # resolution -> retention of the rollups, None to keep them forever
+        self.rollups = dict(self.db.execute("""
+            SELECT Resolution, Retention
+            FROM SENSOR_ROLLUP_RESOLUTION
+            ORDER BY Resolution
+            """))
+        # retention of the raw logs, set by prune()
+        self.retention = None
+        self.pruning = None
 
     @property
     def devices(self):
         d = {}
-        for did, pdid, Error in self.execute("""
-                SELECT DEVICE.ID, Parent, DEVICE_STATUS_LOG.Error
+        for did, pdid, Date, Error in self.execute("""
+                SELECT DEVICE.ID, Parent, Date, Error
                 FROM DEVICE
-                JOIN DEVICE_STATUS_LOG
-                ON DEVICE_STATUS_LOG.Device = DEVICE.ID
-                GROUP BY DEVICE.ID
-                ORDER BY DEVICE_STATUS_LOG.ID DESC
+                JOIN DEVICE_STATUS_CURRENT
+                ON DEVICE_STATUS_CURRENT.Device = DEVICE.ID
                 """):
-            d[did] = CoiotDBDevice(self, did, pdid, Error=bool(Error))
+            d[did] = CoiotDBDevice(self, did, pdid, Date, Error=bool(Error),
+                                   load=False)
+        CoiotDBInterface.load_many(self, d)
         return d
 
     def install(self, parent=None):
@@ -382,12 +871,190 @@ class CoiotDB:
 
     def execute(self, req, *args):
         """
-        Executes the query after performing type conversion on custom types.
+        Executes the normalized query, custom types are converted by their
+        sqlite3 adapters.
+        Pending log inserts are written first so that queries always see them.
+        """
+        self.writes.flush()
+        return self.db.execute(statement(req), args)
+
+    def history_levels(self, start):
+        """
+        Returns the levels of the sensor history still holding the entries
+        from start, finest first: 0 for the raw log, else the resolution of
+        the rollup. The coarsest rollup is always returned.
+        """
+        age = CoiotDatetime.now().epoch - start
+        levels = [(0, self.retention)] + list(self.rollups.items())
+        return [r for r, retention in levels
+                if retention is None or age <= retention] or \
+            [levels[-1][0]]
+
+    def prune(self, max_age, connection=None, chunk=10000):
+        """
+        Retention policy: deletes the log entries older than max_age seconds
+        and the rollup buckets older than the retention of their resolution.
+        The current values and the coarser rollups are kept.
+        Entries are deleted chunk at a time, one transaction each, so that
+        the writer is never blocked for long. connection is the writer by
+        default, see prune_async().
+        """
+        if connection is None:
+            self.writes.flush()
+            connection = self.db
+        self.retention = max_age
+        now = CoiotDatetime.now().epoch
+        before = now - max_age
+        for table, owner, owners in (
+                ("SENSOR_LOG", "Sensor", "SENSOR"),
+                ("SWITCHABLE_LOG", "Switchable", "SWITCHABLE"),
+                ("DEVICE_STATUS_LOG", "Device", "DEVICE")):
+            pruned = chunk
+            total = 0
+            while pruned == chunk:
+                pruned = connection.execute(statement("""
+                    DELETE FROM {0}
+                    WHERE rowid IN (
+                        SELECT rowid
+                        FROM {0}
+                        WHERE {1} IN (SELECT ID FROM {2}) AND Date < ?
+                        LIMIT ?)
+                    """.format(table, owner, owners)),
+                    (before, chunk)).rowcount
+                total += pruned
+            log.info("pruned {} entries from {}".format(total, table))
+        connection.execute(statement("""
+            DELETE FROM SENSOR_ROLLUP
+            WHERE Bucket < ? - (
+                SELECT Retention
+                FROM SENSOR_ROLLUP_RESOLUTION
+                WHERE Resolution = SENSOR_ROLLUP.Resolution)
+            """), (now,))
+
+    def prune_async(self, max_age):
+        """
+        Runs prune() in a thread, on its own connection, unless it is still
+        running. Returns the thread.
+        """
+        if self.pruning is not None and self.pruning.is_alive():
+            return self.pruning
+        self.writes.flush()
+        self.retention = max_age
+
+        def prune():
+            c = self.connections.connect(self.connections.filename,
+                                         check_same_thread=False)
+            c.isolation_level = None
+            try:
+                self.prune(max_age, c)
+            finally:
+                c.close()
+        self.pruning = threading.Thread(target=prune, name="prune")
+        self.pruning.start()
+        return self.pruning
+
+    def export(self, name, start, end, chunk=10000):
+        """
+        Returns the entries of the log name (see EXPORTS) from start to end
+        (excluded) as columns: a dict of column name to array.array, with
+        the owner ID, the epoch date and the values of each entry, ordered
+        by owner and date.
+        The arrays support the buffer protocol, eg numpy.frombuffer() reads
+        them without a copy. Rows are read chunk by chunk, so only the
+        columns are kept in memory.
+        """
+        table, owner, owners, values = EXPORTS[name]
+        columns = {owner: array.array('q'), 'Date': array.array('d')}
+        for column, typecode in values:
+            columns[column] = array.array(typecode)
+        req = """
+            SELECT {0}, Date, {1}
+            FROM {2}
+            WHERE {0} IN (SELECT ID FROM {3}) AND Date >= ? AND Date < ?
+            ORDER BY {0}, Date
+            """.format(owner, ", ".join(v for v, _ in values), table, owners)
+        c = self.query(req, start, end)
+        arrays = list(columns.values())
+        rows = c.fetchmany(chunk)
+        while rows:
+            for a, column in zip(arrays, zip(*rows)):
+                a.extend(column)
+            rows = c.fetchmany(chunk)
+        return columns
+
+    def query(self, req, *args):
+        """
+        Executes a read-only query on the read-only connection of the calling
+        thread, so that long (eg history) queries do not block the writer.
+        The query sees the committed data only, the pending log inserts are
+        written first when called from the writer thread.
         """
-        sqlite_args = ()
-        for a in args:
-            if type(a) is CoiotDatetime:
-                a = a.epoch
-            sqlite_args += (a,)
+        if self.connections.is_writer():
+            self.writes.flush()
+        return self.connections.reader.execute(statement(req), args)
+
+    def log(self, req, *args):
+        """
+        Queues a log insert in the write-behind queue, see CoiotDBWriteQueue.
+        """
+        self.writes.push(statement(req), args)
+
+    def log_many(self, req, rows):
+        """
+        Queues a log insert for each of the rows, they are written with a
+        single executemany() when the queue is flushed.
+        """
+        self.writes.push_many(statement(req), rows)
+
+    def flush(self):
+        """
+        Commits all the pending log inserts.
+        """
+        self.writes.flush()
+
+    def close(self):
+        self.flush()
+        self.connections.close()
+
+
+NPY_TYPES = {'b': '|i1', 'q': '<i8', 'd': '<f8'}
+
+
+def write_npz(columns, f):
+    """
+    Writes the columns returned by CoiotDB.export() to the file object f as
+    a NumPy .npz archive: one .npy file per column, readable with
+    numpy.load().
+    """
+    with zipfile.ZipFile(f, 'w') as z:
+        for name, a in columns.items():
+            header = ("{{'descr': '{}', 'fortran_order': False, "
+                      "'shape': ({},), }}").format(NPY_TYPES[a.typecode],
+                                                   len(a))
+            # magic, version, header length and header padded to 64 bytes
+            header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+            with z.open(name + '.npy', 'w') as npy:
+                npy.write(b'\x93NUMPY\x01\x00')
+                npy.write(len(header).to_bytes(2, 'little'))
+                npy.write(header.encode('latin1'))
+                if sys.byteorder != 'little' and a.itemsize > 1:
+                    a = array.array(a.typecode, a)
+                    a.byteswap()
+                npy.write(a.tobytes())
+
+
+def write_arrow(columns, f):
+    """
+    Writes the columns returned by CoiotDB.export() to the file object f in
+    the Arrow IPC file format. This requires pyarrow.
+    """
+    import pyarrow
 
-        return self.db.execute(req, sqlite_args)
+    types = {'b': pyarrow.int8(), 'q': pyarrow.int64(),
+             'd': pyarrow.float64()}
+    table = pyarrow.table({
+        name: pyarrow.Array.from_buffers(types[a.typecode], len(a),
+                                         [None, pyarrow.py_buffer(a)])
+        for name, a in columns.items()})
+    with pyarrow.ipc.new_file(f, table.schema) as writer:
+        writer.write_table(table)
@@ -1,39 +1,245 @@
+import collections
+import os
+import sys
 import threading
+import time
+import weakref
+
+
+class Wakeup:
+    """
+    File descriptor that is readable while signalled, so that a main loop
+    (eg GLib.io_add_watch) can sleep until there is something to do instead
+    of polling.
+    An eventfd is used when available, a pipe otherwise. The signalled
+    flag and the file descriptor are updated together under lock, else a
+    clear() draining the write of a concurrent signal() would leave the
+    flag set on an empty file descriptor, and no later signal() would wake
+    up the main loop.
+    """
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK |
+                                             os.EFD_CLOEXEC)
+        else:
+            self.rfd, self.wfd = os.pipe()
+            for fd in self.rfd, self.wfd:
+                os.set_blocking(fd, False)
+        self.signalled = False
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.rfd
+
+    def signal(self):
+        if self.signalled:
+            return
+        with self.lock:
+            if not self.signalled:
+                self.signalled = True
+                os.write(self.wfd, (1).to_bytes(8, sys.byteorder))
+
+    def clear(self):
+        with self.lock:
+            if self.signalled:
+                self.signalled = False
+                try:
+                    os.read(self.rfd, 4096)
+                except BlockingIOError:
+                    pass
+
+
+# Priority classes of the actions, lower values are popped first
+USER = 0
+SYNC = 1
+TELEMETRY = 2
+PRIORITIES = (USER, SYNC, TELEMETRY)
+
+
+class Producer:
+    """
+    Queue of a producer thread, kept in its thread-local storage: the queue
+    is retired once the thread ends.
+    """
+    def __init__(self, queue):
+        self.queue = queue
 
 
 class DeviceActionList:
+    """
+    Scheduler of the actions on devices:
+    - actions on the same (device, key) are coalesced: only the latest value
+    is kept, at the position (and with the wait time) of the first one
+    - actions are popped by priority class: user commands, then state
+    synchronisation, then telemetry
+    - in a priority class, devices are served round-robin and the actions of
+    a device in FIFO order
+
+    Any number of producer threads can set() actions, but a single consumer
+    thread pops them. Each producer appends to its own queue (a deque, whose
+    appends and pops are atomic) and only the consumer touches the
+    scheduler, so that producers only wait for the short lock of the wakeup
+    signal, and only when it is not signalled yet. The queues of the ended
+    producer threads are dropped once emptied.
+    """
     def __init__(self):
         self.list = {}
-        self.cv = threading.Condition()
+        # per priority: device -> keys, in order
+        self.queues = [collections.OrderedDict() for p in PRIORITIES]
+        # per producer queues of (device, key, value, priority, date), and
+        # the ones of the ended producers
+        self.producers = []
+        self.retired = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.wakeup = Wakeup()
+        self.max_depth = 0
+        self.coalesced = 0
+        self.popped = [0 for p in PRIORITIES]
+        self.wait = [0. for p in PRIORITIES]
+        self.max_wait = [0. for p in PRIORITIES]
 
     def __bool__(self):
-        return bool(self.list)
+        return bool(self.list) or any(self.producers)
+
+    def fileno(self):
+        """
+        File descriptor readable as long as the list is not empty.
+        """
+        return self.wakeup.fileno()
+
+    def set(self, d, k, v, priority=SYNC):
+        try:
+            queue = self.local.producer.queue
+        except AttributeError:
+            queue = collections.deque()
+            self.local.producer = Producer(queue)
+            weakref.finalize(self.local.producer, self.retire, queue)
+            with self.lock:
+                self.producers = self.producers + [queue]
+        queue.append((d, k, v, priority, time.monotonic()))
+        self.wakeup.signal()
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def retire(self, queue):
+        """
+        Called when the producer of queue ends, from any thread.
+        """
+        with self.lock:
+            self.retired.append(queue)
 
-    def set(self, d, k, v):
-        with self.cv:
-            self.list[d, k] = v
-            self.cv.notify()
+    def schedule(self):
+        """
+        Moves the actions set by the producers to the scheduler, the wakeup
+        signals are cleared first so that no later action is missed.
+        """
+        self.ready.clear()
+        self.wakeup.clear()
+        for queue in self.producers:
+            while queue:
+                d, k, v, priority, date = queue.popleft()
+                action = self.list.get((d, k))
+                if action is None:
+                    self.list[d, k] = [v, priority, date]
+                else:
+                    self.coalesced += 1
+                    action[0] = v
+                    if priority >= action[1]:
+                        continue
+                    # the entry in the lower priority queue is now stale
+                    action[1] = priority
+                self.queues[priority].setdefault(d, collections.deque()) \
+                    .append(k)
+        if self.retired:
+            with self.lock:
+                # emptied above, unless retired meanwhile
+                done = {id(q) for q in self.retired if not q}
+                self.retired = [q for q in self.retired if q]
+                self.producers = [q for q in self.producers
+                                  if id(q) not in done]
+        self.max_depth = max(self.max_depth, len(self.list))
+
+    def pop_action(self):
+        for priority, queue in zip(PRIORITIES, self.queues):
+            while queue:
+                d, keys = next(iter(queue.items()))
+                k = keys.popleft()
+                if keys:
+                    queue.move_to_end(d)
+                else:
+                    del queue[d]
+
+                action = self.list.get((d, k))
+                if action is None or action[1] != priority:
+                    continue
+                del self.list[d, k]
+                wait = time.monotonic() - action[2]
+                self.popped[priority] += 1
+                self.wait[priority] += wait
+                self.max_wait[priority] = max(self.max_wait[priority], wait)
+                return (d, k, action[0])
+
+    def pop_many(self, n, timeout=0):
+        """
+        Pops at most n actions, waiting at most timeout seconds (forever if
+        None) for the first one.
+        """
+        self.schedule()
+        if not self.list and timeout != 0:
+            self.ready.wait(timeout)
+            self.schedule()
+        actions = []
+        while self.list and len(actions) < n:
+            actions.append(self.pop_action())
+        self.rearm()
+        return actions
+
+    def rearm(self):
+        # keep the consumer awake for the remaining actions
+        if self.list:
+            self.wakeup.signal()
+            self.ready.set()
 
     def pop(self, timeout=0.5):
-        with self.cv:
-            self.cv.wait_for(lambda: self.list, timeout)
-            if self.list:
-                (d, k), v = self.list.popitem()
-                return (d, k, v)
-            else:
-                # timeout
-                return None
+        actions = self.pop_many(1, timeout)
+        if actions:
+            return actions[0]
+        else:
+            # timeout
+            return None
+
+    def stats(self):
+        """
+        Returns the queue depth and wait time statistics, wait times are in
+        seconds and given per priority class.
+        Like pop(), this must be called from the consumer thread.
+        """
+        self.schedule()
+        self.rearm()
+        return {
+            'depth': len(self.list),
+            'max_depth': self.max_depth,
+            'coalesced': self.coalesced,
+            'popped': list(self.popped),
+            'avg_wait': [w / n if n else 0.
+                         for w, n in zip(self.wait, self.popped)],
+            'max_wait': list(self.max_wait),
+        }
 
 
 class DALDevice:
     """
     Abstraction to access a device from another thread:
-    - setting attribute will be done through the DeviceActionList
+    - setting attribute will be done through the DeviceActionList, with the
+    given priority
     - getting attributes is done from the device directly
     """
-    def __init__(self, device, dal):
+    def __init__(self, device, dal, priority=SYNC):
         self.dal = dal
         self.device = device
+        self.priority = priority
 
     def __getattr__(self, k):
         if not k[0].isupper():
@@ -45,4 +251,4 @@ class DALDevice:
             super().__setattr__(k, v)
         else:
             if v != getattr(self.device, k):
-                self.dal.set(self.device, k, v)
+                self.dal.set(self.device, k, v, self.priority)
@@ -0,0 +1,253 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+from coiot.device_action_list import DeviceActionList
+
+log = logging.getLogger('Driver')
+
+# Maximum number of actions popped at once by a driver
+ACTIONS_BATCH = 100
+
+
+class DriverRuntime:
+    """
+    A single asyncio event loop, running in its own thread, shared by all
+    the drivers, so that adding a driver adds no polling loop. The blocking
+    calls (D-Bus, network) run in the bounded executor of each driver.
+    """
+    instance = None
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name='drivers',
+                                       daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(Cls):
+        if Cls.instance is None:
+            Cls.instance = Cls()
+        return Cls.instance
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """
+        Schedules a coroutine from any thread, returns a
+        concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def cancel(self, tasks):
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout=5):
+        """
+        Cancels the remaining tasks and stops the loop.
+        """
+        if self.loop.is_closed():
+            return
+        tasks = asyncio.all_tasks(self.loop)
+        self.submit(self.cancel(tasks)).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+        if DriverRuntime.instance is self:
+            DriverRuntime.instance = None
+
+
+class Driver:
+    """
+    Base class of the drivers, running as a task on the DriverRuntime.
+    Subclasses implement the coroutines:
+    - probe(), called every probe_interval seconds (None: never) or when
+    request_probe() is called, to look for the devices and refresh their
+    state
+    - write(d, k, v), called for each action popped from the action list
+    - flush(), called after each batch of writes, for drivers that stage
+    the writes to send them together; the batch gathers the actions set
+    within batch_window seconds
+    Each call is cancelled after timeout seconds. The probe(), write() and
+    flush() calls of a driver never overlap.
+    The blocking calls run in the own executor of the driver, of workers
+    threads, so that blocked calls of a driver do not delay the other
+    drivers. With more than one worker, the blocking calls of a driver may
+    run at once: the state they share needs locking. A cancelled call keeps
+    running in its thread until it returns: the blocking calls must be
+    bounded themselves (eg D-Bus call timeouts).
+    The tasks a driver runs besides its calls are created by create_task(),
+    so that stop() cancels them too.
+    """
+    probe_interval = 1
+    batch_window = 0
+    timeout = 10
+    workers = 2
+
+    def __init__(self, runtime=None, autostart=True):
+        self.action_list = DeviceActionList()
+        self.runtime = runtime
+        self.task = None
+        self.executor = None
+        # tasks created by create_task(), until they are done
+        self.tasks = set()
+        self.stopped = False
+        self.busy = asyncio.Lock()
+        self.probe_requested = asyncio.Event()
+        if autostart:
+            self.start()
+
+    def start(self):
+        if self.runtime is None:
+            self.runtime = DriverRuntime.get()
+        self.stopped = False
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers, thread_name_prefix=str(self))
+        self.task = self.runtime.submit(self.spawn()).result()
+
+    async def spawn(self):
+        return asyncio.create_task(self.main())
+
+    def stop(self, timeout=5):
+        """
+        Cancels the driver tasks and waits for them to finish.
+        Like start(), it must not be called from the runtime thread.
+        """
+        if self.task is None:
+            return
+        self.stopped = True
+        try:
+            self.runtime.submit(self.cancel_tasks()).result(timeout)
+        except concurrent.futures.TimeoutError:
+            log.error("{}: still running after {}s".format(self, timeout))
+        self.task = None
+        # the calls still running are not waited for
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+    async def cancel_tasks(self):
+        tasks = [self.task] + list(self.tasks)
+        # wait_for() may swallow the cancellation of a call that completes,
+        # the tasks are cancelled again until they are done
+        while not all(t.done() for t in tasks):
+            for t in tasks:
+                t.cancel()
+            await asyncio.wait(tasks, timeout=0.1)
+
+    def create_task(self, coro):
+        """
+        Runs coro in a task of the driver, from the event loop: the task is
+        kept until it is done, its failure is logged, and stop() cancels it.
+        """
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("{}: task failed".format(self),
+                      exc_info=task.exception())
+
+    def call_soon(self, f, *args):
+        """
+        Calls f in the event loop, can be called from any thread.
+        """
+        self.runtime.loop.call_soon_threadsafe(f, *args)
+
+    def request_probe(self):
+        """
+        Wakes the probe loop up, can be called from any thread.
+        """
+        if self.runtime is not None:
+            self.runtime.loop.call_soon_threadsafe(self.probe_requested.set)
+
+    async def main(self):
+        await asyncio.gather(self.probe_loop(), self.write_loop())
+
+    async def call(self, f, *args, **kwargs):
+        """
+        Runs a blocking call in the executor of the driver, or in the
+        default one of the loop when not started.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(f, *args,
+                                                            **kwargs))
+
+    async def probe(self):
+        pass
+
+    async def write(self, d, k, v):
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+    async def probe_loop(self):
+        while not self.stopped:
+            self.probe_requested.clear()
+            try:
+                async with self.busy:
+                    await asyncio.wait_for(self.probe(), self.timeout)
+            except asyncio.TimeoutError:
+                log.error("{}: probe timed out".format(self))
+            except Exception:
+                log.exception("{}: probe failed".format(self))
+            try:
+                await asyncio.wait_for(self.probe_requested.wait(),
+                                       self.probe_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_actions(self):
+        """
+        Waits until the action list is not empty.
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        fd = self.action_list.fileno()
+        loop.add_reader(fd, on_ready)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+
+    async def write_loop(self):
+        while not self.stopped:
+            await self.wait_actions()
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            for d, k, v in self.action_list.pop_many(ACTIONS_BATCH):
+                try:
+                    async with self.busy:
+                        await asyncio.wait_for(self.write(d, k, v),
+                                               self.timeout)
+                except asyncio.TimeoutError:
+                    log.error("{}: write {} = {} timed out".format(self, k, v))
+                except Exception:
+                    log.exception("{}: write {} = {} failed"
+                                  .format(self, k, v))
+            try:
+                async with self.busy:
+                    await asyncio.wait_for(self.flush(), self.timeout)
+            except asyncio.TimeoutError:
+                log.error("{}: flush timed out".format(self))
+            except Exception:
+                log.exception("{}: flush failed".format(self))
+
+    def __str__(self):
+        return type(self).__name__
@@ -1,9 +1,17 @@
+import asyncio
+import concurrent.futures
+import requests
+import requests.adapters
 import soco
+import soco.config
 import soco.exceptions
-import threading
-from coiot.device_action_list import DeviceActionList, DALDevice
-from coiot.db import CoiotDBInterface, sqlite_cast
+import soco.services
+from soco.data_structures import DidlObject, DidlResource, to_didl_string
+from coiot.device_action_list import DALDevice, USER
+from coiot.driver import Driver
+from coiot.db import CoiotDBInterface, sqlite_cast, load_rows
 import logging
+import threading
 import time
 
 log = logging.getLogger('SONOS')
@@ -20,9 +28,20 @@ class SonosDevice:
         if r is None:
             return False
 
-        self.__id, self.Zone = r
+        Cls.hydrate(self, *r)
         return True
 
+    @classmethod
+    def load_many(Cls, db, devices):
+        return load_rows(devices, db.execute("""
+            SELECT Device, ID, Zone
+            FROM DRIVER_SONOS
+            """), Cls.hydrate)
+
+    @classmethod
+    def hydrate(Cls, self, iid, Zone):
+        self.__id, self.Zone = iid, Zone
+
     @classmethod
     def install(Cls, self, Zone):
         Zone = sqlite_cast(str, Zone)
@@ -39,14 +58,15 @@ class SonosDevice:
         self.playing = False
         if not SonosDriver.instance:
             return
-        try:
-            player = SonosDriver.instance.devices[self.Zone]
-            self.Online = True
-            for f in dir(player):
-                if f[0].isupper():
-                    setattr(self, f, getattr(player, f))
-        except StopIteration:
+        player = SonosDriver.instance.devices.get(self.Zone)
+        if player is None or player.lost:
+            # not discovered yet, set online by the discovery
             self.Online = False
+            return
+        self.Online = True
+        for f in dir(player):
+            if f[0].isupper():
+                setattr(self, f, getattr(player, f))
 
     @classmethod
     def register(Cls):
@@ -55,8 +75,8 @@ class SonosDevice:
     @classmethod
     def autodetect(self):
         return list((z
-                     for z, p in SonosDriver.instance.devices.items()
-                     if not p.cache))
+                     for z, p in list(SonosDriver.instance.devices.items())
+                     if p.cache is None and not p.lost))
 
     @property
     def driver(self):
@@ -88,31 +108,304 @@ class SonosDevice:
         self.playing = v
 
 
+class PlayerEvents:
+    """
+    Event queue of the subscriptions of a player: instead of being queued,
+    the events are handed to the driver event loop.
+    """
+    def __init__(self, player):
+        self.player = player
+
+    def put(self, event):
+        self.player.driver.call_soon(self.player.driver.event, self.player,
+                                     event)
+
+
+class PooledRequests:
+    """
+    Stands for the requests module in soco.services: the UPnP requests go
+    through a single session, keeping the connections to the players alive
+    (at most maxsize per player) instead of opening one per request.
+    """
+    def __init__(self, maxsize=2):
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_connections=32, pool_maxsize=maxsize))
+
+    def __getattr__(self, k):
+        return getattr(requests, k)
+
+    def get(self, *args, **kwargs):
+        return self.session.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.session.post(*args, **kwargs)
+
+
 class SonosPlayer:
+    """
+    Once subscribed to the AVTransport and RenderingControl events, the
+    player state is read from the evented variables: only the position,
+    which is not evented, is queried when the transport or the track
+    changes, and extrapolated in between.
+    Otherwise, the replies of the player are kept SNAPSHOT_TTL seconds, so
+    that reading all the fields costs a single request of each kind; the
+    snapshots are dropped by any write, and a reply fetched while a write
+    happened is not kept.
+    While subscribed, the queue is mirrored once read (queue), along with
+    its UpdateID: the queue edits update the mirror, and an event giving
+    another number of tracks or an UpdateID our edits did not return drops
+    it. The edits send the UpdateID of the mirror, 0 without one, so that
+    the player rejects them if the queue changed meanwhile. The edits are
+    done by ranges, so that setting NextSong costs the same requests
+    whatever the queue length.
+    The commands of a player run one at a time on its own worker thread,
+    so that a player that does not answer only delays its own commands; at
+    most MAX_PENDING of them wait for the worker.
+    After BREAKER_FAILURES network errors in a row, the requests to the
+    player fail at once for BREAKER_RESET seconds, then a single request is
+    let through to probe it again, the others failing until it is answered.
+    """
+    SNAPSHOT_TTL = 1
+    BREAKER_FAILURES = 3
+    BREAKER_RESET = 30
+    MAX_PENDING = 4
+    # tracks per AddMultipleURIsToQueue and per page of the queue
+    QUEUE_CHUNK = 16
+    QUEUE_PAGE = 100
+    # evented variables of the state, and the fields they give
+    STATE = {
+        'transport_state': 'Playing',
+        'current_track_uri': 'CurrentSong',
+        'current_track_duration': 'SongDuration',
+        'volume': 'Volume',
+    }
+
     def __init__(self, driver, phy):
         self.driver = driver
         self.phy = phy
         self.zone = self.phy.player_name
         self.cache = None
+        # discoveries in a row the player was missing from
+        self.misses = 0
+        self.subscriptions = []
+        self.state = {}
+        # (position in seconds, time.monotonic() of the position)
+        self.position = None
+        # request -> (reply, time.monotonic() of the reply), and the number
+        # of times they were dropped
+        self.snapshots = {}
+        self.generation = 0
+        self.snapshots_lock = threading.Lock()
+        # URIs of the queue, None if unknown, its UpdateID, and the UpdateIDs
+        # returned since it was read
+        self.queue = None
+        self.queue_update_id = 0
+        self.queue_update_ids = set()
+        self.worker = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix=self.zone)
+        # commands submitted to the worker and not done, from the event loop
+        self.pending = 0
+        # network errors in a row, end of the open state of the breaker, and
+        # whether the probe request is running
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.breaker = threading.Lock()
+        # set in the threads running a request
+        self.requesting = threading.local()
+
+    def __setattr__(self, k, v):
+        super().__setattr__(k, v)
+        if k[0].isupper():
+            self.drop_snapshots()
+
+    def drop_snapshots(self, request=None):
+        """
+        Drops the snapshot of request, all of them by default.
+        """
+        with self.snapshots_lock:
+            self.generation += 1
+            if request is None:
+                self.snapshots.clear()
+            else:
+                self.snapshots.pop(request, None)
+
+    def snapshot(self, request):
+        now = time.monotonic()
+        with self.snapshots_lock:
+            s = self.snapshots.get(request)
+            generation = self.generation
+        if s is not None and now - s[1] <= SonosPlayer.SNAPSHOT_TTL:
+            return s[0]
+        r = self.request(getattr(self.phy, request))
+        with self.snapshots_lock:
+            # dropped meanwhile, the reply may predate a write
+            if self.generation == generation:
+                self.snapshots[request] = r, now
+        return r
+
+    @property
+    def available(self):
+        with self.breaker:
+            return self.failures < SonosPlayer.BREAKER_FAILURES or \
+                (not self.probing and time.monotonic() >= self.open_until)
+
+    def request(self, f, *args):
+        """
+        Calls f(*args) through the circuit breaker. The requests made by f
+        count as part of it.
+        """
+        if getattr(self.requesting, 'active', False):
+            return f(*args)
+        with self.breaker:
+            probe = self.failures >= SonosPlayer.BREAKER_FAILURES
+            if probe and (self.probing or
+                          time.monotonic() < self.open_until):
+                raise ConnectionError("\"{}\" is not reachable"
+                                      .format(self.zone))
+            if probe:
+                self.probing = True
+        reachable = True
+        self.requesting.active = True
+        try:
+            return f(*args)
+        except OSError:
+            reachable = False
+            raise
+        finally:
+            self.requesting.active = False
+            self.answered(probe, reachable)
+
+    def answered(self, probe, reachable):
+        with self.breaker:
+            if probe:
+                self.probing = False
+            failures = self.failures
+            if reachable:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= SonosPlayer.BREAKER_FAILURES:
+                    self.open_until = time.monotonic() + \
+                        SonosPlayer.BREAKER_RESET
+        if reachable and failures >= SonosPlayer.BREAKER_FAILURES:
+            log.info("\"{}\" is reachable again".format(self.zone))
+            self.set_online(True)
+        elif not reachable and failures + 1 >= SonosPlayer.BREAKER_FAILURES:
+            log.warning("\"{}\": {} failures, retry in {}s"
+                        .format(self.zone, failures + 1,
+                                SonosPlayer.BREAKER_RESET))
+            self.set_online(False)
+
+    def set_online(self, online):
+        """
+        Sets Online in the cache from the event loop, can be called from any
+        thread.
+        """
+        def update():
+            if self.cache is not None:
+                self.cache.Online = online
+        self.driver.call_soon(update)
+
+    def subscribe(self):
+        self.unsubscribe()
+        events = PlayerEvents(self)
+        for service in self.phy.avTransport, self.phy.renderingControl, \
+                soco.services.Queue(self.phy):
+            self.subscriptions.append(service.subscribe(auto_renew=True,
+                                                        event_queue=events))
+
+    def unsubscribe(self):
+        for sub in self.subscriptions:
+            try:
+                sub.unsubscribe()
+            except Exception as e:
+                log.warning("{}: {}".format(self.zone, e))
+        self.subscriptions = []
+        self.state = {}
+        self.position = None
+        self.drop_queue()
+
+    @property
+    def lost(self):
+        return self.misses >= SonosDriver.discovery_misses
+
+    @property
+    def subscribed(self):
+        return bool(self.subscriptions) and \
+            all(sub.is_subscribed for sub in self.subscriptions)
+
+    def handle_event(self, event):
+        """
+        Updates the state from the event, returns the updated fields.
+        """
+        if self.position is not None:
+            self.position = self.current_position(), time.monotonic()
+        fields = []
+        for k, field in SonosPlayer.STATE.items():
+            if k in event.variables:
+                self.state[k] = event.variables[k]
+                fields.append(field)
+        for k in 'current_track', 'number_of_tracks':
+            if k in event.variables:
+                self.state[k] = int(event.variables[k])
+        if 'update_id' in event.variables:
+            update_id = int(event.variables['update_id'])
+            if update_id in self.queue_update_ids:
+                # our own edit, the former ones are not evented anymore
+                self.queue_update_ids = {i for i in self.queue_update_ids
+                                         if i >= update_id}
+            elif self.queue is not None:
+                log.debug("\"{}\" queue edited".format(self.zone))
+                self.drop_queue()
+        if self.queue is not None and \
+                self.state.get('number_of_tracks') != len(self.queue):
+            log.debug("\"{}\" queue changed".format(self.zone))
+            self.drop_queue()
+        return fields
+
+    def refresh_position(self):
+        self.drop_snapshots('get_current_track_info')
+        cti = self.safe_track_info()
+        self.position = SonosPlayer.hms_to_s(cti['position']), \
+            time.monotonic()
+
+    def current_position(self):
+        position, date = self.position
+        if self.Playing:
+            position += time.monotonic() - date
+        return position
+
+    def push(self, keys):
+        """
+        Pushes the fields keys to the cache.
+        """
+        if self.cache is None:
+            return
+        for k in keys:
+            setattr(self.cache, k, getattr(self, k))
 
     def safe_transport_info(self):
         try:
-            return self.phy.get_current_transport_info()
-        except ConnectionError as e:
+            return self.snapshot('get_current_transport_info')
+        except OSError as e:
             log.error(e)
-            self.cache.Online = False
+            self.set_online(False)
             return {'current_transport_state': 'STOPPED'}
 
     def safe_track_info(self):
         try:
-            return self.phy.get_current_track_info()
-        except ConnectionError as e:
+            return self.snapshot('get_current_track_info')
+        except OSError as e:
             log.error(e)
-            self.cache.Online = False
+            self.set_online(False)
             return {'duration': 0, 'position': 0, 'uri': ''}
 
     @property
     def Playing(self):
+        if 'transport_state' in self.state:
+            return self.state['transport_state'] == 'PLAYING'
         cti = self.safe_transport_info()
         return cti['current_transport_state'] == 'PLAYING'
 
@@ -125,7 +418,9 @@ class SonosPlayer:
 
     @property
     def Volume(self):
-        return self.phy.volume / 100.0
+        if 'volume' in self.state:
+            return int(self.state['volume']['Master']) / 100.0
+        return self.request(getattr, self.phy, 'volume') / 100.0
 
     @Volume.setter
     def Volume(self, v):
@@ -145,11 +440,15 @@ class SonosPlayer:
 
     @property
     def SongDuration(self):
+        if 'current_track_duration' in self.state:
+            return SonosPlayer.hms_to_s(self.state['current_track_duration'])
         cti = self.safe_track_info()
         return SonosPlayer.hms_to_s(cti['duration'])
 
     @property
     def CurrentTime(self):
+        if self.position is not None:
+            return int(self.current_position())
         cti = self.safe_track_info()
         return SonosPlayer.hms_to_s(cti['position'])
 
@@ -159,85 +458,318 @@ class SonosPlayer:
 
     @property
     def CurrentSong(self):
+        if 'current_track_uri' in self.state:
+            return self.state['current_track_uri']
         cti = self.safe_track_info()
 
         return cti['uri']
 
     @CurrentSong.setter
     def CurrentSong(self, v):
-        self.phy.clear_queue()
+        self.request(self.phy.clear_queue)
+        # the UpdateID of the cleared queue is not returned
+        self.drop_queue()
+        if 'number_of_tracks' in self.state:
+            self.state['number_of_tracks'] = 0
         if v:
-            self.phy.add_uri_to_queue(v)
-            self.phy.play_from_queue(0)
+            self.add_to_queue([v])
+            self.request(self.phy.play_from_queue, 0)
             self.cache.Playing = False
 
+    def set_queue(self, uris, update_id):
+        """
+        Mirrors the queue, while subscribed.
+        """
+        if not self.subscribed:
+            return
+        self.queue = uris
+        self.queue_update_id = update_id
+        self.queue_update_ids.add(update_id)
+        self.state['number_of_tracks'] = len(uris)
+
+    def drop_queue(self):
+        self.queue = None
+        self.queue_update_id = 0
+        self.queue_update_ids = set()
+
+    def get_queue(self):
+        """
+        Returns the URIs of the queue, from the mirror if any.
+        """
+        if self.queue is not None:
+            return self.queue
+        uris = []
+        while True:
+            q = self.request(self.phy.get_queue, len(uris),
+                             SonosPlayer.QUEUE_PAGE)
+            uris += [item.resources[0].uri for item in q]
+            if not len(q) or len(uris) >= q.total_matches:
+                break
+        self.set_queue(uris, int(q.update_id))
+        return uris
+
+    def queue_length(self):
+        if self.queue is not None:
+            return len(self.queue)
+        if 'number_of_tracks' in self.state:
+            return self.state['number_of_tracks']
+        return self.request(getattr, self.phy, 'queue_size')
+
+    def next_track(self):
+        """
+        Index of the track after the current one in the queue.
+        """
+        return self.state.get('current_track', 1)
+
+    def add_to_queue(self, uris, position=None):
+        """
+        Inserts the URIs at position in the queue, at its end by default,
+        QUEUE_CHUNK URIs per request.
+        """
+        if position is None and self.queue is not None:
+            position = len(self.queue)
+        for i in range(0, len(uris), SonosPlayer.QUEUE_CHUNK):
+            chunk = uris[i:i + SonosPlayer.QUEUE_CHUNK]
+            items = [DidlObject(resources=[DidlResource(
+                uri=uri, protocol_info="x-rincon-playlist:*:*:*")],
+                title="", parent_id="", item_id="") for uri in chunk]
+            r = self.request(self.phy.avTransport.AddMultipleURIsToQueue, [
+                ('InstanceID', 0),
+                ('UpdateID', self.queue_update_id),
+                ('NumberOfURIs', len(chunk)),
+                ('EnqueuedURIs', " ".join(chunk)),
+                ('EnqueuedURIsMetaData',
+                 " ".join(to_didl_string(item) for item in items)),
+                ('ContainerURI', ""),
+                ('ContainerMetaData', ""),
+                # 1-based, 0 is the end of the queue
+                ('DesiredFirstTrackNumberEnqueued',
+                 0 if position is None else position + i + 1),
+                ('EnqueueAsNext', 0),
+            ])
+            if self.queue is not None:
+                queue = list(self.queue)
+                queue[position + i:position + i] = chunk
+                self.set_queue(queue, int(r['NewUpdateID']))
+            elif 'number_of_tracks' in self.state:
+                self.state['number_of_tracks'] += len(chunk)
+
+    def remove_from_queue(self, start, count):
+        """
+        Removes count tracks of the queue from start, in a single request.
+        """
+        if count <= 0:
+            return
+        r = self.request(self.phy.avTransport.RemoveTrackRangeFromQueue, [
+            ('InstanceID', 0),
+            ('UpdateID', self.queue_update_id),
+            ('StartingIndex', start + 1),
+            ('NumberOfTracks', count),
+        ])
+        if self.queue is not None:
+            self.set_queue(self.queue[:start] + self.queue[start + count:],
+                           int(r['NewUpdateID']))
+        elif 'number_of_tracks' in self.state:
+            self.state['number_of_tracks'] -= count
+
+    def replace_queue(self, start, count, uris):
+        """
+        Replaces count tracks of the queue from start with the URIs.
+        """
+        self.remove_from_queue(start, count)
+        self.add_to_queue(uris, start)
+
     @property
     def NextSong(self):
-        q = self.phy.get_queue(1, 1)
-
+        i = self.next_track()
+        if self.queue is not None:
+            return self.queue[i] if i < len(self.queue) else ''
+        q = self.request(self.phy.get_queue, i, 1)
         if not q:
             return ''
-
-        dt = q[0].to_dict()
-        return dt['resources'][0]['uri']
+        return q[0].resources[0].uri
 
     @NextSong.setter
     def NextSong(self, v):
-        while self.NextSong:
-            self.phy.remove_from_queue(1)
-        self.phy.add_uri_to_queue(v)
-
-
-class SonosDriver(threading.Thread):
+        # the tracks after the current one are replaced by v
+        start = self.next_track()
+        count = max(self.queue_length() - start, 0)
+        self.replace_queue(start, count, [v] if v else [])
+
+
+class SonosDriver(Driver):
+    """
+    The players state is evented: the probe loop only subscribes the
+    players every probe_interval seconds until they are, and polls the
+    players that cannot be subscribed.
+    The players are discovered in the background, every discovery_interval
+    seconds: a player is lost once missing from discovery_misses discoveries
+    in a row. on_discovery(), if set, is called from the event loop when new
+    zones are found, for SonosDevice.autodetect() to install them.
+    The writes are handed to the worker of their player without waiting
+    for them, so that a player that does not answer does not delay the
+    next batches: a write that could not start within timeout seconds is
+    dropped, the UPnP requests are bounded by request_timeout seconds.
+    Since soco keeps them in module globals, the request timeout and the
+    pooled requests apply to the whole process while the driver is started,
+    and stop() restores the previous ones.
+    """
     instance = None
+    probe_interval = 3
+    request_timeout = 5
+    discovery_interval = 60
+    discovery_timeout = 5
+    discovery_misses = 2
 
-    def __init__(self, cache_update):
-        super().__init__()
+    def __init__(self, cache_update, autostart=True, runtime=None):
         self.cache_update = cache_update
-        self.player_update = DeviceActionList()
-        self.devices = {phy.player_name: SonosPlayer(self, phy)
-                        for phy in soco.discover()}
-        self.stopped = False
-        self.last_tick = None
-        self.refresh = {}
+        # zone -> SonosPlayer
+        self.devices = {}
+        # zone -> DALDevice of the registered devices
+        self.caches = {}
+        self.on_discovery = None
+        self.next_discovery = 0
+        # soco settings replaced while started
+        self.soco_settings = None
         SonosDriver.instance = self
         SonosDevice.register()
-        self.start()
+        super().__init__(runtime, autostart)
+
+    def start(self):
+        # process-wide: every soco user of the process gets the pooled
+        # requests and request_timeout until stop()
+        if self.soco_settings is None:
+            self.soco_settings = soco.config.REQUEST_TIMEOUT, \
+                soco.services.requests
+            soco.config.REQUEST_TIMEOUT = SonosDriver.request_timeout
+            soco.services.requests = PooledRequests()
+        super().start()
 
     def stop(self):
-        self.stopped = True
-
-    def run(self):
-        while not self.stopped:
-            tick = time.time()
-            if not self.last_tick:
-                self.last_tick = tick
-
-            if tick - self.last_tick > 1:
-                elapsed = int(tick - self.last_tick)
-                self.tick(elapsed)
-                self.last_tick += elapsed
-
-            t = self.player_update.pop()
-            if t is not None:
-                d, k, v = t
-                try:
-                    player = self.devices[d.Zone]
-                    setattr(player, k, v)
-                    setattr(player.cache, k, v)
-                    log.info("update \"{}\" {} = {}".format(d.Zone, k, v))
-                except soco.exceptions.SoCoUPnPException as e:
-                    log.error(e)
-
-    def tick(self, elapsed):
-        for player in self.devices.values():
-            self.refresh.setdefault(player, 0)
-            self.refresh[player] += elapsed
-
-            if self.refresh[player] > 3:
-                self.refresh[player] = 0
-                player.cache.Playing = player.Playing
+        for player in list(self.devices.values()):
+            player.unsubscribe()
+            player.worker.shutdown(wait=False)
+        super().stop()
+        if self.soco_settings is not None:
+            soco.services.requests.session.close()
+            soco.config.REQUEST_TIMEOUT, soco.services.requests = \
+                self.soco_settings
+            self.soco_settings = None
+
+    def discover(self):
+        """
+        Adds the new players and drops the lost ones, returns the new zones.
+        """
+        found = {phy.player_name: phy
+                 for phy in soco.discover(
+                     timeout=SonosDriver.discovery_timeout) or ()}
+        new = []
+        for zone, phy in found.items():
+            player = self.devices.get(zone)
+            if player is None:
+                log.info("\"{}\" discovered".format(zone))
+                player = self.devices[zone] = SonosPlayer(self, phy)
+                player.cache = self.caches.get(zone)
+                new.append(zone)
+            elif player.phy is not phy or player.lost:
+                log.info("\"{}\" found again".format(zone))
+                player.unsubscribe()
+                player.phy = phy
+                player.drop_snapshots()
+            player.misses = 0
+            if player.cache is not None:
+                player.cache.Online = True
+        for zone, player in list(self.devices.items()):
+            if zone in found:
+                continue
+            player.misses += 1
+            if player.misses != SonosDriver.discovery_misses:
+                continue
+            log.warning("\"{}\" lost".format(zone))
+            player.unsubscribe()
+            if player.cache is None:
+                del self.devices[zone]
+            else:
+                player.cache.Online = False
+        return new
+
+    def refresh(self):
+        for player in list(self.devices.values()):
+            if player.subscribed or player.lost or not player.available:
+                continue
+            try:
+                player.request(player.subscribe)
+                log.info("\"{}\" subscribed".format(player.zone))
+            except Exception as e:
+                log.warning("\"{}\" subscription failed: {}"
+                            .format(player.zone, e))
+                if player.cache is not None:
+                    player.cache.Playing = player.Playing
+
+    async def probe(self):
+        if time.monotonic() >= self.next_discovery:
+            self.next_discovery = time.monotonic() + \
+                SonosDriver.discovery_interval
+            if await self.call(self.discover) and \
+                    self.on_discovery is not None:
+                self.on_discovery()
+        await self.call(self.refresh)
+
+    def event(self, player, event):
+        """
+        Called in the event loop for each event of a player.
+        """
+        log.debug("\"{}\" event {}".format(player.zone, event.variables))
+        fields = player.handle_event(event)
+        player.push(fields)
+        if 'Playing' in fields or 'CurrentSong' in fields:
+            self.create_task(self.refresh_position(player))
+
+    async def refresh_position(self, player):
+        await self.call(player.refresh_position)
+        player.push(('CurrentTime',))
+
+    async def write(self, d, k, v):
+        player = self.devices.get(d.Zone)
+        if player is None or player.lost:
+            log.warning("\"{}\" is not reachable".format(d.Zone))
+            return
+        self.create_task(self.command(player, k, v))
+
+    async def command(self, player, k, v):
+        """
+        Runs the write of k on the worker of the player, unless it could not
+        start within timeout seconds. The cache is updated once it is done.
+        """
+        if player.pending >= SonosPlayer.MAX_PENDING:
+            log.error("\"{}\" {} = {} dropped: {} commands pending"
+                      .format(player.zone, k, v, player.pending))
+            return
+        deadline = time.monotonic() + self.timeout
+
+        def run():
+            if time.monotonic() > deadline:
+                raise TimeoutError("not started within {}s"
+                                   .format(self.timeout))
+            player.request(setattr, player, k, v)
+
+        player.pending += 1
+        try:
+            await asyncio.wrap_future(player.worker.submit(run))
+        except soco.exceptions.SoCoUPnPException as e:
+            log.error(e)
+            return
+        except OSError as e:
+            log.error("\"{}\" {} = {} failed: {}".format(player.zone, k, v,
+                                                         e))
+            return
+        finally:
+            player.pending -= 1
+        setattr(player.cache, k, v)
+        log.info("update \"{}\" {} = {}".format(player.zone, k, v))
 
     def register(self, cache):
-        self.devices[cache.Zone].cache = DALDevice(cache, self.cache_update)
-        return DALDevice(cache, self.player_update)
+        self.caches[cache.Zone] = DALDevice(cache, self.cache_update)
+        if cache.Zone in self.devices:
+            self.devices[cache.Zone].cache = self.caches[cache.Zone]
+        return DALDevice(cache, self.action_list, USER)
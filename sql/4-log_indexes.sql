@@ -0,0 +1,12 @@
+-- Index the append-only log tables.
+-- The latest entry of an owner is found through (owner, ID DESC) and
+-- history ranges through (owner, Date), so that neither needs to scan
+-- the whole log.
+CREATE INDEX DEVICE_STATUS_LOG_DEVICE_ID ON DEVICE_STATUS_LOG(Device, ID DESC);
+CREATE INDEX DEVICE_STATUS_LOG_DEVICE_DATE ON DEVICE_STATUS_LOG(Device, Date);
+
+CREATE INDEX SWITCHABLE_LOG_SWITCHABLE_ID ON SWITCHABLE_LOG(Switchable, ID DESC);
+CREATE INDEX SWITCHABLE_LOG_SWITCHABLE_DATE ON SWITCHABLE_LOG(Switchable, Date);
+
+CREATE INDEX SENSOR_LOG_SENSOR_ID ON SENSOR_LOG(Sensor, ID DESC);
+CREATE INDEX SENSOR_LOG_SENSOR_DATE ON SENSOR_LOG(Sensor, Date);
@@ -0,0 +1,70 @@
+-- Snapshot of the latest entry of each log.
+-- The *_CURRENT tables hold one row per owner, kept up to date by triggers
+-- on the log tables, so that loading a device does not read its history.
+CREATE TABLE DEVICE_STATUS_CURRENT (
+	Device INTEGER PRIMARY KEY,
+	Date DATETIME NOT NULL,
+	Online BOOLEAN NOT NULL,
+	Error BOOLEAN NOT NULL,
+
+	FOREIGN KEY(Device) REFERENCES DEVICE(ID)
+);
+
+INSERT INTO DEVICE_STATUS_CURRENT(Device, Date, Online, Error)
+SELECT Device, Date, Online, Error
+FROM DEVICE_STATUS_LOG
+WHERE ID IN (SELECT MAX(ID) FROM DEVICE_STATUS_LOG GROUP BY Device);
+
+CREATE TRIGGER DEVICE_STATUS_LOG_CURRENT
+AFTER INSERT ON DEVICE_STATUS_LOG
+BEGIN
+	INSERT OR REPLACE INTO DEVICE_STATUS_CURRENT(Device, Date, Online, Error)
+	VALUES(NEW.Device, NEW.Date, NEW.Online, NEW.Error);
+END;
+
+CREATE TABLE SWITCHABLE_CURRENT (
+	Switchable INTEGER PRIMARY KEY,
+	Date DATETIME NOT NULL,
+	Value BOOLEAN NOT NULL,
+
+	FOREIGN KEY(Switchable) REFERENCES SWITCHABLE(ID)
+);
+
+INSERT INTO SWITCHABLE_CURRENT(Switchable, Date, Value)
+SELECT Switchable, Date, Value
+FROM SWITCHABLE_LOG
+WHERE ID IN (SELECT MAX(ID) FROM SWITCHABLE_LOG GROUP BY Switchable);
+
+CREATE TRIGGER SWITCHABLE_LOG_CURRENT
+AFTER INSERT ON SWITCHABLE_LOG
+BEGIN
+	INSERT OR REPLACE INTO SWITCHABLE_CURRENT(Switchable, Date, Value)
+	VALUES(NEW.Switchable, NEW.Date, NEW.Value);
+END;
+
+CREATE TABLE SENSOR_CURRENT (
+	Sensor INTEGER PRIMARY KEY,
+	Date DATE NOT NULL,
+	Value INTEGER NOT NULL,
+
+	FOREIGN KEY(Sensor) REFERENCES SENSOR(ID)
+);
+
+INSERT INTO SENSOR_CURRENT(Sensor, Date, Value)
+SELECT Sensor, Date, Value
+FROM SENSOR_LOG
+WHERE ID IN (SELECT MAX(ID) FROM SENSOR_LOG GROUP BY Sensor);
+
+CREATE TRIGGER SENSOR_LOG_CURRENT
+AFTER INSERT ON SENSOR_LOG
+BEGIN
+	INSERT OR REPLACE INTO SENSOR_CURRENT(Sensor, Date, Value)
+	VALUES(NEW.Sensor, NEW.Date, NEW.Value);
+END;
+
+-- Interfaces are looked up by device
+CREATE INDEX DISPLAYABLE_DEVICE ON DISPLAYABLE(Device);
+CREATE INDEX SWITCHABLE_DEVICE ON SWITCHABLE(Device);
+CREATE INDEX SENSOR_DEVICE ON SENSOR(Device);
+CREATE INDEX DRIVER_BLE_DEVICE ON DRIVER_BLE(Device);
+CREATE INDEX DRIVER_SONOS_DEVICE ON DRIVER_SONOS(Device);
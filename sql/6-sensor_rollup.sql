@@ -0,0 +1,48 @@
+-- Time-bucketed rollups of SENSOR_LOG.
+-- Each resolution (in seconds) of SENSOR_ROLLUP_RESOLUTION has its own
+-- min/max/sum/count buckets in SENSOR_ROLLUP, fed by a trigger as the
+-- samples are logged. Retention is the age (in seconds) after which the
+-- buckets of a resolution are pruned, NULL to keep them forever.
+CREATE TABLE SENSOR_ROLLUP_RESOLUTION (
+	Resolution INTEGER PRIMARY KEY,
+	Retention INTEGER
+);
+INSERT INTO SENSOR_ROLLUP_RESOLUTION(Resolution, Retention) VALUES(60, 2592000);
+INSERT INTO SENSOR_ROLLUP_RESOLUTION(Resolution, Retention) VALUES(3600, NULL);
+INSERT INTO SENSOR_ROLLUP_RESOLUTION(Resolution, Retention) VALUES(86400, NULL);
+
+CREATE TABLE SENSOR_ROLLUP (
+	Sensor INTEGER NOT NULL,
+	Resolution INTEGER NOT NULL,
+	Bucket DATETIME NOT NULL,
+	Min FLOAT NOT NULL,
+	Max FLOAT NOT NULL,
+	Sum FLOAT NOT NULL,
+	Count INTEGER NOT NULL,
+
+	PRIMARY KEY(Sensor, Resolution, Bucket),
+	FOREIGN KEY(Sensor) REFERENCES SENSOR(ID),
+	FOREIGN KEY(Resolution) REFERENCES SENSOR_ROLLUP_RESOLUTION(Resolution)
+) WITHOUT ROWID;
+
+INSERT INTO SENSOR_ROLLUP(Sensor, Resolution, Bucket, Min, Max, Sum, Count)
+SELECT Sensor, Resolution, CAST(Date / Resolution AS INTEGER) * Resolution,
+       min(Value), max(Value), sum(Value), count(*)
+FROM SENSOR_LOG, SENSOR_ROLLUP_RESOLUTION
+GROUP BY Sensor, Resolution, CAST(Date / Resolution AS INTEGER);
+
+CREATE TRIGGER SENSOR_LOG_ROLLUP
+AFTER INSERT ON SENSOR_LOG
+BEGIN
+	INSERT INTO SENSOR_ROLLUP(Sensor, Resolution, Bucket, Min, Max, Sum, Count)
+	SELECT NEW.Sensor, Resolution,
+	       CAST(NEW.Date / Resolution AS INTEGER) * Resolution,
+	       NEW.Value, NEW.Value, NEW.Value, 1
+	FROM SENSOR_ROLLUP_RESOLUTION
+	WHERE true
+	ON CONFLICT(Sensor, Resolution, Bucket) DO UPDATE
+	SET Min = min(Min, excluded.Min),
+	    Max = max(Max, excluded.Max),
+	    Sum = Sum + excluded.Sum,
+	    Count = Count + 1;
+END;
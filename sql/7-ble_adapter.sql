@@ -0,0 +1,2 @@
+-- Adapter of the BLE devices, NULL to let coiotd choose one
+ALTER TABLE DRIVER_BLE ADD COLUMN Adapter TEXT;
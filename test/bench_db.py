@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""
+Database benchmarks.
+They are not part of the unit tests as they take a while, run them with:
+    python -m unittest test.bench_db
+"""
+from coiot.db import CoiotDB, CoiotDBDevice, CoiotDBInterface
+from coiot.db import Switchable, Displayable, Sensor
+from ble.db_interface import BLEDriverParameters
+from coiot.datetime import CoiotDatetime
+import os
+import time
+import unittest
+
+DEVICES = 100
+
+
+def seed(filename, devices, history):
+    """
+    Creates a database of devices Switchable, Displayable BLE devices, each
+    of them having history entries in every log table.
+    """
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    db = CoiotDB(filename)
+    for i in range(devices):
+        d = db.install()
+        d.install_interface(Switchable, On=False)
+        d.install_interface(Displayable, Name=str(i), Type="Lamp")
+        d.install_interface(BLEDriverParameters, Mac="00:00:00:00:00:00",
+                            Idx=i)
+
+    now = CoiotDatetime.now().epoch
+    dids = [did for did, in db.execute("SELECT ID FROM DEVICE")]
+    sids = [sid for sid, in db.execute("SELECT ID FROM SWITCHABLE")]
+    db.execute("BEGIN")
+    db.db.executemany("""
+        INSERT INTO DEVICE_STATUS_LOG(Device, Date, Online, Error)
+        VALUES(?, ?, 1, 0)
+        """, ((did, now - n) for n in range(history) for did in dids))
+    db.db.executemany("""
+        INSERT INTO SWITCHABLE_LOG(Switchable, Date, Value)
+        VALUES(?, ?, ?)
+        """, ((sid, now - n, n % 2) for n in range(history) for sid in sids))
+    db.execute("COMMIT")
+    return filename
+
+
+def best_of(f, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class DevicesLoadBench(unittest.TestCase):
+    """
+    CoiotDB.devices must depend on the number of devices, not on the size
+    of the logs.
+    """
+    def per_device(self, history):
+        filename = seed("/tmp/coiot_bench.db", DEVICES, history)
+        db = CoiotDB(filename)
+        t = best_of(lambda: self.assertEqual(DEVICES, len(db.devices)))
+        print("\n{} devices, {} log entries per device: {:.1f}us/device"
+              .format(DEVICES, history, t / DEVICES * 1e6))
+        return t / DEVICES
+
+    def test_history_size(self):
+        small = self.per_device(1)
+        large = self.per_device(5000)
+        self.assertLess(large, small * 3)
+
+
+class BulkLoadBench(unittest.TestCase):
+    """
+    CoiotDB.devices loads each interface table once for all the devices,
+    compare it to loading the devices one by one.
+    """
+    def setUp(self):
+        BLEDriverParameters.register()
+
+    def tearDown(self):
+        CoiotDBInterface.undeclare(BLEDriverParameters)
+
+    def test_bulk(self):
+        devices = 500
+        filename = seed("/tmp/coiot_bench.db", devices, 1)
+        db = CoiotDB(filename)
+        rows = list(db.execute("SELECT ID, Parent FROM DEVICE"))
+
+        def load_single():
+            return {did: CoiotDBDevice(db, did, pdid) for did, pdid in rows}
+
+        single = best_of(lambda: self.assertEqual(devices,
+                                                  len(load_single())))
+        bulk = best_of(lambda: self.assertEqual(devices, len(db.devices)))
+        print("\n{} devices: {:.1f}ms one by one, {:.1f}ms in bulk"
+              .format(devices, single * 1e3, bulk * 1e3))
+        self.assertLess(bulk, single)
+
+
+class SetterBench(unittest.TestCase):
+    """
+    Throughput of the Switchable.On setter
+    """
+    def updates_per_second(self, **kwargs):
+        filename = seed("/tmp/coiot_bench.db", 1, 1)
+        db = CoiotDB(filename, **kwargs)
+        _, device = db.devices.popitem()
+        updates = 2000
+
+        def switch():
+            for i in range(updates):
+                device.On = bool(i % 2)
+            db.flush()
+
+        t = best_of(switch, repeat=3)
+        print("\nSwitchable.On {}: {:.0f} updates/s".format(kwargs,
+                                                            updates / t))
+        return updates / t
+
+    def test_write_through(self):
+        self.updates_per_second()
+
+    def test_write_behind(self):
+        self.assertLess(self.updates_per_second(),
+                        self.updates_per_second(write_delay=1))
+
+
+class SensorIngestBench(unittest.TestCase):
+    """
+    Throughput of the batched sensor ingestion
+    """
+    def test_record(self):
+        filename = seed("/tmp/coiot_bench.db", 0, 0)
+        db = CoiotDB(filename, write_delay=1, write_batch=5000)
+        sensor = db.install()
+        sensor.install_interface(Sensor, Unit="Degree F", Exponent=-1)
+        samples, batch = 20000, 100
+        now = CoiotDatetime.now().epoch
+
+        def record():
+            for i in range(0, samples, batch):
+                sensor.record([(now + j, 700 + j % 100)
+                               for j in range(i, i + batch)])
+            db.flush()
+
+        t = best_of(record, repeat=3)
+        print("\nSensor.record: {:.0f} samples/s".format(samples / t))
+        self.assertGreater(samples / t, 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+"""
+DeviceActionList stress benchmark.
+It is not part of the unit tests as it takes a while, run it with:
+    python -m unittest test.bench_device_action_list
+"""
+from coiot.device_action_list import DeviceActionList, USER, TELEMETRY
+import threading
+import time
+import unittest
+
+DEVICES = 5000
+KEYS = 4
+ROUNDS = 10
+PRODUCERS = 4
+BATCH = 100
+
+
+class StressBench(unittest.TestCase):
+    """
+    Several producers flood the list with telemetry of thousands of devices
+    while user commands are sent, a single consumer pops the actions.
+    """
+    def test_flood(self):
+        dal = DeviceActionList()
+        done = threading.Event()
+
+        def produce(p):
+            for r in range(ROUNDS):
+                for d in range(p, DEVICES, PRODUCERS):
+                    for k in range(KEYS):
+                        dal.set(d, k, r, TELEMETRY)
+                dal.set("lamp{}".format(p), "On", r % 2 == 0, USER)
+
+        producers = [threading.Thread(target=produce, args=(p,))
+                     for p in range(PRODUCERS)]
+        popped = []
+
+        def consume():
+            while not done.is_set() or dal:
+                popped.extend(dal.pop_many(BATCH, timeout=0.1))
+
+        consumer = threading.Thread(target=consume)
+        start = time.perf_counter()
+        consumer.start()
+        for t in producers:
+            t.start()
+        for t in producers:
+            t.join()
+        done.set()
+        consumer.join()
+        elapsed = time.perf_counter() - start
+
+        stats = dal.stats()
+        sets = DEVICES * KEYS * ROUNDS + PRODUCERS * ROUNDS
+        print("\n{} sets, {} pops in {:.2f}s: {:.0f} sets/s, max depth {}"
+              .format(sets, len(popped), elapsed, sets / elapsed,
+                      stats['max_depth']))
+        print("wait avg/max: user {:.2f}/{:.2f}ms, telemetry {:.2f}/{:.2f}ms"
+              .format(stats['avg_wait'][USER] * 1e3,
+                      stats['max_wait'][USER] * 1e3,
+                      stats['avg_wait'][TELEMETRY] * 1e3,
+                      stats['max_wait'][TELEMETRY] * 1e3))
+        self.assertEqual(sets, len(popped) + stats['coalesced'])
+        self.assertLessEqual(stats['avg_wait'][USER],
+                             stats['avg_wait'][TELEMETRY])
+
+
+if __name__ == "__main__":
+    unittest.main()
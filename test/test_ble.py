@@ -1,9 +1,12 @@
+import asyncio
 import logging
 import sys
 import unittest
 from unittest.mock import Mock
 from gi.repository import GLib
 from ble import driver, gatt_uuid
+from ble.device import CALL_TIMEOUT
+from coiot.device_action_list import SYNC
 
 log = logging.getLogger('BLE')
 log.addHandler(logging.StreamHandler(sys.stdout))
@@ -23,6 +26,7 @@ class TestBle(unittest.TestCase):
     def setUp(self):
         self.gpio = Mock()
         self.gpio.ReadValue.return_value = [0]
+        self.gpio.Flags = ['read', 'write']
 
         aiod = Mock()
         aiod.characteristics = {
@@ -45,7 +49,8 @@ class TestBle(unittest.TestCase):
     def test_setup(self):
         self.assertTrue(self.adapter.proxy.Powered)
         self.driver.refresh_devices()
-        self.gpio.ReadValue.assert_called_once_with(aio_offset(None))
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(None), timeout=CALL_TIMEOUT)
         self.assertEqual(1, len(self.driver.ble_devices))
 
         client_device = self.driver.ble_devices["00:01:02:03:04:05"]
@@ -66,6 +71,43 @@ class TestBle(unittest.TestCase):
         self.driver.refresh_devices()
         self.assertTrue(cache.Mac in self.driver.ble_devices)
 
+    def test_probe_on_connect(self):
+        a = "00:01:02:03:04:05"
+        self.driver.update_device(a, self.device, True)
+        self.assertTrue(a in self.driver.ble_devices)
+
+        self.gpio.ReadValue.reset_mock()
+        self.driver.update_device(a, self.device, True)
+        self.gpio.ReadValue.assert_not_called()
+
+        self.driver.update_device(a, self.device, False)
+        self.assertTrue(a not in self.driver.ble_devices)
+
+    def test_connections(self):
+        a = "00:01:02:03:04:05"
+        cache = Mock(Mac=a, Idx=0)
+        self.driver.updates = Mock()
+        self.driver.register(cache)
+        self.assertTrue(self.driver.connections.peripheral(a).target)
+
+        async def signal(connected):
+            self.driver.device_changed(a, self.device, connected)
+            for i in range(2):
+                await self.driver.probe()
+                await self.driver.connections.join()
+        self.driver.runtime = Mock()
+        self.driver.runtime.loop.call_soon_threadsafe = \
+            lambda f, *args: f(*args)
+
+        asyncio.run(signal(False))
+        self.device.proxy.Connect.assert_called_once_with(
+            timeout=self.driver.connections.timeout)
+        self.assertTrue(a not in self.driver.ble_devices)
+
+        asyncio.run(signal(True))
+        self.assertTrue(a in self.driver.ble_devices)
+        self.assertTrue(self.driver.connections.peripheral(a).ready)
+
 
 class TestDigital(TestBle):
     """
@@ -82,11 +124,13 @@ class TestDigital(TestBle):
 
     def test_switch_on_off(self):
         self.client_device[0].On = True
-        self.gpio.WriteValue.assert_called_once_with([1], aio_offset(0))
+        self.gpio.WriteValue.assert_called_once_with(
+            [1], aio_offset(0), timeout=CALL_TIMEOUT)
 
         self.gpio.WriteValue.reset_mock()
         self.client_device[0].On = False
-        self.gpio.WriteValue.assert_called_once_with([0], aio_offset(0))
+        self.gpio.WriteValue.assert_called_once_with(
+            [0], aio_offset(0), timeout=CALL_TIMEOUT)
 
     def test_write_does_no_read(self):
         self.gpio.ReadValue.reset_mock()
@@ -108,21 +152,143 @@ class TestMultipleDigital(TestBle):
 
         client_device = self.driver.ble_devices["00:01:02:03:04:05"]
         self.assertEqual(2, len(client_device))
-        self.gpio.ReadValue.assert_called_once_with(aio_offset(None))
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(None), timeout=CALL_TIMEOUT)
 
         self.gpio.ReadValue = Mock(return_value=[0])
         self.assertEqual(False, client_device[0].On)
-        self.gpio.ReadValue.assert_called_once_with(aio_offset(0))
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(0), timeout=CALL_TIMEOUT)
 
         self.gpio.ReadValue = Mock(return_value=[1])
         self.assertEqual(True, client_device[1].On)
-        self.gpio.ReadValue.assert_called_once_with(aio_offset(1))
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(1), timeout=CALL_TIMEOUT)
 
     def test_value(self):
         self.driver.refresh_devices()
 
         client_device = self.driver.ble_devices["00:01:02:03:04:05"]
         client_device[0].On = True
-        self.gpio.WriteValue.assert_called_once_with([1], aio_offset(0))
+        self.gpio.WriteValue.assert_called_once_with(
+            [1], aio_offset(0), timeout=CALL_TIMEOUT)
         client_device[1].On = False
-        self.gpio.WriteValue.assert_called_with([0], aio_offset(1))
+        self.gpio.WriteValue.assert_called_with(
+            [0], aio_offset(1), timeout=CALL_TIMEOUT)
+
+    def scene(self, *values):
+        self.driver.refresh_devices()
+        mac = "00:01:02:03:04:05"
+        self.driver.cache[mac] = {i: Mock() for i in range(len(values))}
+
+        async def write():
+            for i, v in enumerate(values):
+                await self.driver.write(Mock(Mac=mac, Idx=i), 'On', v)
+            await self.driver.flush()
+            await self.driver.connections.join()
+        asyncio.run(write())
+        return self.driver.cache[mac]
+
+    def test_write_loop(self):
+        # the actions go through the write loop of the driver to the device
+        mac = "00:01:02:03:04:05"
+        self.driver.refresh_devices()
+        self.driver.cache[mac] = {0: Mock()}
+        self.driver.action_list.set(Mock(Mac=mac, Idx=0), 'On', True)
+
+        async def run():
+            task = asyncio.ensure_future(self.driver.write_loop())
+            while not self.driver.cache[mac][0].On is True:
+                await asyncio.sleep(0.01)
+            task.cancel()
+        asyncio.run(asyncio.wait_for(run(), 5))
+        self.gpio.WriteValue.assert_called_once_with(
+            [1, 0], {}, timeout=CALL_TIMEOUT)
+
+    def test_batch(self):
+        cache = self.scene(True, True)
+        self.gpio.WriteValue.assert_called_once_with([1, 1], {},
+                                                     timeout=CALL_TIMEOUT)
+        self.assertEqual(True, cache[1].On)
+
+    def test_batch_reads_first(self):
+        self.driver.refresh_devices()
+        # gpio 1 set elsewhere since the probe
+        self.gpio.ReadValue.return_value = [0, 1]
+        self.scene(True)
+        self.gpio.WriteValue.assert_called_once_with(
+            [1, 1], {}, timeout=CALL_TIMEOUT)
+
+    def test_stage_during_flush(self):
+        self.driver.refresh_devices()
+        gpios = self.driver.ble_devices["00:01:02:03:04:05"]
+        gpios[0].stage('On', True)
+
+        def read(*args, **kwargs):
+            # gpio 1 staged by the next batch, while flushing
+            gpios[1].stage('On', True)
+            return [0, 0]
+        self.gpio.ReadValue.side_effect = read
+        gpios[0].flush()
+        self.gpio.WriteValue.assert_called_once_with(
+            [1, 0], {}, timeout=CALL_TIMEOUT)
+
+        self.gpio.ReadValue.side_effect = None
+        self.gpio.ReadValue.return_value = [1, 0]
+        gpios[1].flush()
+        self.gpio.WriteValue.assert_called_with(
+            [1, 1], {}, timeout=CALL_TIMEOUT)
+
+    def test_batch_without_response(self):
+        self.gpio.Flags = ['read', 'write', 'write-without-response']
+        self.scene(False, True)
+        self.gpio.WriteValue.assert_called_once_with(
+            [0, 1], {'type': GLib.Variant('s', 'command')},
+            timeout=CALL_TIMEOUT)
+
+
+class TestNotify(TestBle):
+    """
+    A single device, with multiple digital io notifying their changes
+    """
+    def setUp(self):
+        super().setUp()
+        self.gpio.Flags = ['read', 'write', 'notify']
+        self.gpio.ReadValue.return_value = [0, 1]
+        self.driver.refresh_devices()
+        self.client_device = self.driver.ble_devices["00:01:02:03:04:05"]
+        self.notify = self.gpio.PropertiesChanged.connect.call_args[0][0]
+
+    def test_setup(self):
+        self.gpio.StartNotify.assert_called_once_with(timeout=CALL_TIMEOUT)
+        self.assertEqual(False, self.client_device[0].On)
+        self.assertEqual(True, self.client_device[1].On)
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(None), timeout=CALL_TIMEOUT)
+
+    def test_notify(self):
+        cache = Mock()
+        cache.Mac = "00:01:02:03:04:05"
+        cache.Idx = 1
+        cache.On = True
+        self.driver.updates = Mock()
+        self.driver.register(cache)
+
+        self.notify('org.bluez.GattCharacteristic1', {'Value': [1, 0]}, [])
+        self.assertEqual(True, self.client_device[0].On)
+        self.assertEqual(False, self.client_device[1].On)
+        self.driver.updates.set.assert_called_once_with(cache, 'On', False,
+                                                        SYNC)
+
+    def test_write_updates_buffer(self):
+        self.client_device[0].On = True
+        self.assertEqual(True, self.client_device[0].On)
+        self.gpio.ReadValue.assert_called_once_with(
+            aio_offset(None), timeout=CALL_TIMEOUT)
+
+    def test_disconnect(self):
+        self.device.proxy.Connected = False
+        self.driver.refresh_devices()
+        self.gpio.PropertiesChanged.connect.return_value.disconnect \
+            .assert_called_once_with()
+        self.gpio.StopNotify.assert_called_once_with(timeout=CALL_TIMEOUT)
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+from ble.connection import ConnectionManager
+import asyncio
+import unittest
+
+
+class ConnectionManagerTest(unittest.TestCase):
+    """
+    Test setup: a manager of peripherals connecting and probing at once,
+    unless they are in the flaky set
+    """
+    def setUp(self):
+        self.connected = []
+        self.probed = []
+        self.flaky = set()
+
+        async def connect(a):
+            if a in self.flaky:
+                raise ConnectionError("flaky")
+            self.connected.append(a)
+
+        async def probe(a):
+            self.probed.append(a)
+        self.manager = ConnectionManager(connect, probe, concurrency=2,
+                                         timeout=0.1, backoff=10)
+
+    def run_manager(self, coro):
+        async def run():
+            await coro
+            await self.manager.join()
+        asyncio.run(run())
+
+    def test_order(self):
+        done = []
+
+        async def op(i):
+            await asyncio.sleep(0.01 * (3 - i))
+            done.append(i)
+
+        async def submit():
+            for i in range(3):
+                self.manager.submit("a", lambda i=i: op(i))
+        self.run_manager(submit())
+        self.assertEqual([0, 1, 2], done)
+
+    def test_slow_peripheral(self):
+        done = []
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            done.append("slow")
+
+        async def fast(a):
+            done.append(a)
+
+        async def submit():
+            self.manager.submit("slow", slow)
+            self.manager.submit("slow", lambda: fast("slow"))
+            for a in "bcd":
+                self.manager.submit(a, lambda a=a: fast(a))
+        self.run_manager(submit())
+        self.assertEqual(["b", "c", "d", "slow", "slow"], done)
+
+    def test_timeout(self):
+        async def hang():
+            await asyncio.sleep(1)
+
+        async def submit():
+            self.manager.submit("a", hang)
+        self.run_manager(submit())
+        self.assertEqual(1, self.manager.peripheral("a").failures)
+
+    def test_concurrency(self):
+        running = []
+        peak = []
+
+        async def op():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        async def submit():
+            for a in range(6):
+                self.manager.submit(a, op)
+        self.run_manager(submit())
+        self.assertEqual(2, max(peak))
+
+    def test_maintain(self):
+        for a in "ab":
+            self.manager.add(a)
+        self.flaky.add("b")
+
+        async def maintain():
+            self.manager.maintain()
+            await self.manager.join()
+            self.manager.set_connected("a", True)
+            self.manager.maintain()
+            # b backs off
+            self.manager.maintain()
+        self.run_manager(maintain())
+        self.assertEqual(["a"], self.connected)
+        self.assertEqual(["a"], self.probed)
+        self.assertTrue(self.manager.peripheral("a").ready)
+        self.assertEqual(1, self.manager.peripheral("b").failures)
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+from ble.router import BLERouter
+from coiot.device_action_list import USER
+from unittest.mock import Mock
+import unittest
+
+
+class FakeDriver:
+    def __init__(self, name):
+        self.name = name
+        self.cache = {}
+        self.known = {}
+        self.action_list = Mock()
+
+    def attach(self, cache):
+        self.cache.setdefault(cache.Mac, []).append(cache)
+
+    def detach(self, mac):
+        return self.cache.pop(mac, [])
+
+
+def cache(mac, adapter=None):
+    return Mock(Mac=mac, Idx=0, Adapter=adapter)
+
+
+def see(driver, mac, rssi=None):
+    driver.known[mac] = Mock(properties={} if rssi is None
+                             else {'RSSI': rssi})
+
+
+class BLERouterTest(unittest.TestCase):
+    """
+    Test setup: a router between three adapters
+    """
+    def setUp(self):
+        self.router = BLERouter()
+        self.drivers = [FakeDriver("hci{}".format(i)) for i in range(3)]
+        for d in self.drivers:
+            self.router.add(d)
+
+    def test_fewest_devices(self):
+        for i in range(6):
+            mac = "00:00:00:00:00:0{}".format(i)
+            for d in self.drivers:
+                see(d, mac)
+            self.router.register(cache(mac))
+        self.assertEqual([2, 2, 2], [len(d.cache) for d in self.drivers])
+
+    def test_rssi(self):
+        mac = "00:00:00:00:00:01"
+        see(self.drivers[0], mac, -80)
+        see(self.drivers[2], mac, -40)
+        self.router.register(cache(mac))
+        self.assertTrue(mac in self.drivers[2].cache)
+
+    def test_pinned(self):
+        mac = "00:00:00:00:00:01"
+        self.router.register(cache(mac, "hci1"))
+        self.assertTrue(mac in self.drivers[1].cache)
+        self.router.connection_failed(self.drivers[1], mac, 10)
+        self.assertTrue(mac in self.drivers[1].cache)
+
+    def test_failover(self):
+        mac = "00:00:00:00:00:01"
+        c = cache(mac)
+        for d in self.drivers[:2]:
+            see(d, mac)
+        dal = self.router.register(c)
+        self.assertTrue(mac in self.drivers[0].cache)
+
+        self.router.connection_failed(self.drivers[0], mac, 1)
+        self.assertTrue(mac in self.drivers[0].cache)
+        self.router.connection_failed(self.drivers[0], mac, 3)
+        self.assertFalse(mac in self.drivers[0].cache)
+        self.assertEqual([c], self.drivers[1].cache[mac])
+
+        dal.On = True
+        self.drivers[1].action_list.set.assert_called_once_with(c, "On", True,
+                                                                USER)
+
+    def test_route_on_discovery(self):
+        mac = "00:00:00:00:00:01"
+        c = cache(mac)
+        dal = self.router.register(c)
+        self.assertEqual([{}, {}, {}], [d.cache for d in self.drivers])
+        dal.On = True
+        for d in self.drivers:
+            d.action_list.set.assert_not_called()
+
+        see(self.drivers[2], mac)
+        self.router.discovered(self.drivers[2], mac)
+        self.assertEqual([c], self.drivers[2].cache[mac])
+
+    def test_failover_seen_only(self):
+        mac = "00:00:00:00:00:01"
+        see(self.drivers[0], mac)
+        self.router.register(cache(mac))
+        self.router.connection_failed(self.drivers[0], mac, 3)
+        self.assertTrue(mac in self.drivers[0].cache)
+
+        see(self.drivers[2], mac)
+        self.router.connection_failed(self.drivers[0], mac, 4)
+        self.assertTrue(mac in self.drivers[2].cache)
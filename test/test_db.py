@@ -1,5 +1,5 @@
 import unittest
-from coiot.db import CoiotDB, Switchable, Displayable
+from coiot.db import CoiotDB, CoiotDBDevice, Switchable, Displayable, Sensor
 import test.logging
 
 test.logging.activate_log('DB')
@@ -51,6 +51,18 @@ class CoiotDBUnitTest(CoiotDBTestSetup):
         self.assertTrue(isinstance(device, Switchable))
         self.assertTrue(not isinstance(d2, Switchable))
 
+    def test_statement(self):
+        from coiot.db import statement
+        self.assertEqual("SELECT 'a  b', \"x\ty\" FROM T WHERE C = 'it''s  '",
+                         statement("""
+            SELECT 'a  b', "x\ty"
+            FROM  T
+            WHERE C = 'it''s  '
+            """))
+        self.assertEqual(("a  b", ), self.db.execute("""
+            SELECT 'a  b'
+            """).fetchone())
+
 
 class OneDeviceTestSetup(CoiotDBTestSetup):
     """
@@ -70,6 +82,20 @@ class OneDeviceTestSetup(CoiotDBTestSetup):
         self.assertEqual(1, len(self.db.devices))
         _, self.device = self.db.devices.popitem()
 
+    def test_error(self):
+        self.device.Error = True
+        self.reload()
+        self.assertTrue(self.device.Error)
+
+        self.device.Error = False
+        self.reload()
+        self.assertTrue(not self.device.Error)
+
+    def test_last_online(self):
+        last_online = self.device.LastOnline
+        self.reload()
+        self.assertEqual(last_online, self.device.LastOnline)
+
 
 class DisplayableUnitTest(OneDeviceTestSetup):
     """
@@ -152,3 +178,262 @@ class SwitchableAndDisplayableUnitTest(OneDeviceTestSetup):
     def test_setup_install(self):
         self.assertTrue(isinstance(self.device, Switchable))
         self.assertTrue(isinstance(self.device, Displayable))
+
+    def test_load_single(self):
+        self.device.On = True
+        self.test_reload()
+        device = CoiotDBDevice(self.db, self.device.id, None)
+        self.assertEqual(str(self.device), str(device))
+        self.assertEqual(self.device.On, device.On)
+
+
+class WriteQueueUnitTest(OneDeviceTestSetup):
+    """
+    Test setup: a Switchable device in a database with a write-behind queue
+    """
+    def setUp(self, cleanup=True, filename="/tmp/coiot.db"):
+        if cleanup:
+            import os
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        self.db = CoiotDB(filename, write_delay=60, write_batch=3)
+        if cleanup:
+            self.device = self.db.install()
+            self.device.install_interface(Switchable, On=False)
+
+    def reload(self):
+        self.db.close()
+        super().reload()
+
+    def test_delayed(self):
+        self.device.On = True
+        self.assertEqual(1, len(self.db.writes))
+        self.db.flush()
+        self.assertEqual(0, len(self.db.writes))
+        self.setUp(cleanup=False)
+        _, self.device = self.db.devices.popitem()
+        self.assertTrue(self.device.On)
+
+    def test_batch(self):
+        self.device.On = True
+        self.device.On = False
+        self.assertEqual(2, len(self.db.writes))
+        self.device.On = True
+        self.assertEqual(0, len(self.db.writes))
+
+    def test_read_flushes(self):
+        self.device.On = True
+        self.device.Error = True
+        self.assertEqual(1, len(self.db.devices))
+        self.assertEqual(0, len(self.db.writes))
+
+    def test_close(self):
+        self.device.On = True
+        self.reload()
+        self.assertTrue(self.device.On)
+
+    def test_scheduler(self):
+        scheduled = []
+        self.db.writes.scheduler = lambda d, f: scheduled.append((d, f))
+        self.device.On = True
+        self.device.On = False
+        self.assertEqual(1, len(scheduled))
+        delay, flush = scheduled[0]
+        self.assertEqual(60, delay)
+        flush()
+        self.assertEqual(0, len(self.db.writes))
+
+
+class ConnectionsUnitTest(OneDeviceTestSetup):
+    """
+    Test setup: a device in a database, accessed from another thread
+    """
+    def test_wal(self):
+        mode, = self.db.execute("PRAGMA journal_mode").fetchone()
+        self.assertEqual("wal", mode)
+
+    def query_thread(self, req):
+        import threading
+        r = []
+        t = threading.Thread(target=lambda: r.append(self.db.query(req)
+                                                     .fetchall()))
+        t.start()
+        t.join()
+        return r[0]
+
+    def test_reader(self):
+        self.device.Error = True
+        self.assertEqual([(self.device.id, 1)], self.query_thread("""
+            SELECT Device, Error
+            FROM DEVICE_STATUS_CURRENT
+            """))
+
+    def test_reader_per_thread(self):
+        import threading
+        self.db.query("SELECT 1")
+        counts = []
+
+        def query():
+            self.db.query("SELECT 1")
+            counts.append(len(self.db.connections.readers))
+        t = threading.Thread(target=query)
+        t.start()
+        t.join()
+        self.assertEqual([2], counts)
+        # closed with its thread
+        self.assertEqual(1, len(self.db.connections.readers))
+
+    def test_read_only(self):
+        import sqlite3
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.query("DELETE FROM DEVICE")
+
+
+class SensorUnitTest(OneDeviceTestSetup):
+    """
+    Test setup: a thermometer in Farenheit, with a 0.1 precision
+    """
+    def setUp(self, cleanup=True, **kwargs):
+        super().setUp(cleanup=cleanup, **kwargs)
+        if cleanup:
+            self.device.install_interface(Sensor, Unit="Degree F",
+                                          Exponent=-1)
+
+    def test_setup_install(self):
+        self.assertTrue(isinstance(self.device, Sensor))
+        self.assertEqual("Degree F", self.device.Unit)
+        self.assertEqual(-1, self.device.Exponent)
+        self.assertEqual(0, self.device.MeasureDate)
+
+    def test_load(self):
+        self.test_reload()
+        self.assertTrue(isinstance(self.device, Sensor))
+        self.assertEqual("Degree F", self.device.Unit)
+
+    def test_install_unknown_unit(self):
+        d2 = self.db.install()
+        with self.assertRaises(Exception):
+            d2.install_interface(Sensor, Unit="Parsec")
+
+    def test_value(self):
+        self.device.Value = 986
+        self.assertEqual(986, self.device.Value)
+        self.reload()
+        self.assertEqual(986, self.device.Value)
+        self.assertNotEqual(0, self.device.MeasureDate)
+
+    def test_fundamental_unit(self):
+        self.device.Value = 986
+        value, = self.db.execute("SELECT Value FROM SENSOR_LOG").fetchone()
+        self.assertAlmostEqual(37, value)
+
+    def test_exponent(self):
+        self.device.Value = 986
+        self.device.Exponent = 0
+        self.assertEqual(99, self.device.Value)
+        self.reload()
+        self.assertEqual(0, self.device.Exponent)
+        self.assertEqual(99, self.device.Value)
+
+    def test_record(self):
+        self.device.record([(float(i), 900 + i) for i in range(100)])
+        self.assertEqual(999, self.device.Value)
+        self.assertEqual(99, self.device.MeasureDate)
+        log = self.device.SensorLog(10, 19)
+        self.assertEqual({float(i): 900 + i for i in range(10, 20)}, log)
+
+    def test_rollup(self):
+        # 2 days of 1 sample per 10 minutes, starting at midnight
+        start = 86400 * 10
+        self.device.record([(start + i * 600., 900 + i % 2)
+                            for i in range(2 * 24 * 6)])
+        minutes = self.device.history(start, start + 3600, points=6)
+        self.assertEqual(6, len(minutes))
+        hours = self.device.history(start, start + 86400, points=24)
+        self.assertEqual(24, len(hours))
+        days = self.device.history(start, start + 2 * 86400, points=2)
+        self.assertEqual(2, len(days))
+        date, vmin, vmax, avg, count = days[0]
+        self.assertEqual(start, date)
+        self.assertEqual(144, count)
+        self.assertAlmostEqual(900, vmin)
+        self.assertAlmostEqual(901, vmax)
+        self.assertAlmostEqual(900.5, avg)
+
+    def test_bounded_log(self):
+        self.device.record([(float(i), 900) for i in range(10000)])
+        self.assertEqual(1000, len(self.device.SensorLog(0, 10000)))
+
+    def test_prune(self):
+        self.device.record([(float(i), 900 + i) for i in range(100)])
+        self.db.prune(3600)
+        self.assertEqual([], self.device.log_page(0, 100, 100)[0])
+        # read from the hourly rollup, the raw log and the minute rollup
+        # are pruned
+        self.assertEqual({0: 950}, self.device.SensorLog(0, 100))
+        self.assertEqual(999, self.device.Value)
+        self.reload()
+        self.assertEqual(999, self.device.Value)
+        r = self.db.execute("SELECT DISTINCT Resolution FROM SENSOR_ROLLUP")
+        self.assertEqual([(3600,), (86400,)], sorted(r))
+
+    def test_prune_async(self):
+        from coiot.datetime import CoiotDatetime
+        now = CoiotDatetime.now().epoch
+        self.device.record([(float(i), 900) for i in range(100)] +
+                           [(now - 10, 901)])
+        self.db.prune_async(3600).join()
+        self.assertEqual([(now - 10, 901)],
+                         self.device.log_page(0, now, 10)[0])
+        self.assertEqual({now - 10: 901}, self.device.SensorLog(now - 60,
+                                                                now))
+
+    def test_log_page(self):
+        self.device.record([(float(i), 900 + i) for i in range(100)])
+        page, cursor = self.device.SensorLogPage(10, 40, 7, '')
+        self.assertEqual({float(i): 900 + i for i in range(10, 17)}, page)
+        page, cursor = self.device.SensorLogPage(10, 40, 7, cursor)
+        self.assertEqual({float(i): 900 + i for i in range(17, 24)}, page)
+
+    def test_log_packed(self):
+        # several measures at the same date
+        self.device.record([(float(i // 2), 900 + i) for i in range(100)])
+        measures = []
+        cursor = ''
+        while True:
+            dates, values, cursor = self.device.SensorLogPacked(10, 40, 7,
+                                                                cursor)
+            measures += zip(dates, values)
+            if not cursor:
+                break
+        self.assertEqual([(float(i // 2), 900 + i) for i in range(20, 80)],
+                         measures)
+
+    def test_iter_log(self):
+        self.device.record([(float(i), 900 + i) for i in range(100)])
+        self.assertEqual([(float(i), 900 + i) for i in range(100)],
+                         list(self.device.iter_log(0, 100, batch=10)))
+
+    def test_export(self):
+        import io
+        import zipfile
+        from coiot.db import write_npz
+        self.device.record([(float(i), 900 + i) for i in range(100)])
+        columns = self.db.export('sensor', 10, 20)
+        self.assertEqual(['Sensor', 'Date', 'Value'], list(columns))
+        self.assertEqual([float(i) for i in range(10, 20)],
+                         list(columns['Date']))
+        self.assertEqual('d', columns['Value'].typecode)
+
+        f = io.BytesIO()
+        write_npz(columns, f)
+        with zipfile.ZipFile(f) as z:
+            self.assertEqual(['Sensor.npy', 'Date.npy', 'Value.npy'],
+                             z.namelist())
+            npy = z.read('Date.npy')
+        self.assertTrue(npy.startswith(b'\x93NUMPY'))
+        header_len = int.from_bytes(npy[8:10], 'little')
+        self.assertEqual(0, (10 + header_len) % 64)
+        self.assertEqual(columns['Date'].tobytes(), npy[10 + header_len:])
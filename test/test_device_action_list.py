@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+from coiot.device_action_list import DeviceActionList, DALDevice
+from coiot.device_action_list import USER, SYNC, TELEMETRY
+from unittest.mock import Mock
+import select
+import threading
+import unittest
+
+
+class DeviceActionListTest(unittest.TestCase):
+    """
+    Test setup: an empty action list
+    """
+    def setUp(self):
+        self.dal = DeviceActionList()
+
+    def readable(self, timeout=0):
+        r, _, _ = select.select([self.dal], [], [], timeout)
+        return bool(r)
+
+    def test_empty(self):
+        self.assertFalse(self.dal)
+        self.assertFalse(self.readable())
+        self.assertEqual(None, self.dal.pop(timeout=0))
+
+    def test_set_pop(self):
+        self.dal.set("d", "On", True)
+        self.assertTrue(self.dal)
+        self.assertEqual(("d", "On", True), self.dal.pop())
+        self.assertFalse(self.dal)
+
+    def test_coalesce(self):
+        self.dal.set("d", "On", True)
+        self.dal.set("d", "On", False)
+        self.assertEqual(("d", "On", False), self.dal.pop())
+        self.assertEqual(None, self.dal.pop(timeout=0))
+
+    def test_wakeup(self):
+        self.dal.set("d", "On", True)
+        self.dal.set("d", "Name", "foo")
+        self.assertTrue(self.readable())
+        self.dal.pop()
+        self.assertTrue(self.readable())
+        self.dal.pop()
+        self.assertFalse(self.readable())
+
+    def test_wakeup_thread(self):
+        t = threading.Thread(target=self.dal.set, args=("d", "On", True))
+        t.start()
+        self.assertTrue(self.readable(timeout=5))
+        t.join()
+        self.assertEqual(("d", "On", True), self.dal.pop())
+
+    def test_fifo(self):
+        for k in range(5):
+            self.dal.set("d", k, k)
+        self.assertEqual([k for k in range(5)],
+                         [self.dal.pop()[1] for k in range(5)])
+
+    def test_round_robin(self):
+        for k in range(3):
+            self.dal.set("d1", k, k)
+        self.dal.set("d2", 0, 0)
+        self.assertEqual([("d1", 0), ("d2", 0), ("d1", 1), ("d1", 2)],
+                         [self.dal.pop()[:2] for k in range(4)])
+
+    def test_priority(self):
+        for d in range(100):
+            self.dal.set(d, "Value", d, TELEMETRY)
+        self.dal.set("lamp", "On", False)
+        self.dal.set("lamp", "On", True, USER)
+        self.assertEqual(("lamp", "On", True), self.dal.pop())
+        self.assertEqual(0, self.dal.pop()[2])
+
+    def test_priority_upgrade(self):
+        self.dal.set("d", "On", True, TELEMETRY)
+        self.dal.set("d", "On", False, USER)
+        self.assertEqual(("d", "On", False), self.dal.pop())
+        self.assertEqual(None, self.dal.pop(timeout=0))
+
+    def test_stats(self):
+        self.dal.set("d", "On", True, USER)
+        self.dal.set("d", "On", False)
+        self.dal.set("d", "Name", "foo", SYNC)
+        stats = self.dal.stats()
+        self.assertEqual(2, stats['depth'])
+        self.assertEqual(1, stats['coalesced'])
+        self.dal.pop()
+        self.dal.pop()
+        stats = self.dal.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(2, stats['max_depth'])
+        self.assertEqual([1, 1, 0], stats['popped'])
+
+    def test_dal_device(self):
+        device = Mock()
+        device.On = False
+        DALDevice(device, self.dal).Name = "foo"
+        DALDevice(device, self.dal, USER).On = True
+        DALDevice(device, self.dal, USER).On = False
+        self.assertEqual([(device, "On", True), (device, "Name", "foo")],
+                         self.dal.pop_many(10))
+
+    def test_pop_many(self):
+        for d in range(10):
+            self.dal.set(d, "On", True)
+        self.assertEqual(list(range(4)),
+                         [d for d, _, _ in self.dal.pop_many(4)])
+        self.assertTrue(self.readable())
+        self.assertEqual(6, len(self.dal.pop_many(10)))
+        self.assertFalse(self.readable())
+
+    def test_producers(self):
+        def produce(p):
+            for d in range(100):
+                self.dal.set(d, p, d)
+        producers = [threading.Thread(target=produce, args=(p,))
+                     for p in range(4)]
+        for t in producers:
+            t.start()
+        for t in producers:
+            t.join()
+        self.assertEqual(4, len(self.dal.producers))
+        self.assertEqual(400, len(self.dal.pop_many(1000)))
+        # the queues of the ended producers are dropped once emptied
+        self.assertEqual([], self.dal.producers)
+
+    def test_no_lost_wakeup(self):
+        popped = []
+
+        def produce(p):
+            for d in range(2000):
+                self.dal.set(d, p, d)
+        producers = [threading.Thread(target=produce, args=(p,))
+                     for p in range(4)]
+        for t in producers:
+            t.start()
+        # the consumer only pops when woken up
+        while len(popped) < 8000 and self.readable(timeout=1):
+            popped += self.dal.pop_many(100)
+        for t in producers:
+            t.join()
+        self.assertEqual(8000, len(popped))
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+from coiot.driver import Driver, DriverRuntime
+import asyncio
+import threading
+import unittest
+
+
+class RecordingDriver(Driver):
+    probe_interval = 0.01
+    timeout = 0.1
+
+    def __init__(self, runtime):
+        self.probed = threading.Event()
+        self.written = []
+        self.flushed = []
+        self.wrote = threading.Event()
+        super().__init__(runtime)
+
+    async def probe(self):
+        self.probed.set()
+
+    async def write(self, d, k, v):
+        if v == "slow":
+            await asyncio.sleep(1)
+        self.written.append((d, k, v))
+
+    async def flush(self):
+        self.flushed.append(len(self.written))
+        self.wrote.set()
+
+
+class DriverTest(unittest.TestCase):
+    """
+    Test setup: a driver recording its calls on a private runtime
+    """
+    def setUp(self):
+        self.runtime = DriverRuntime()
+        self.driver = RecordingDriver(self.runtime)
+
+    def tearDown(self):
+        self.driver.stop()
+        self.runtime.stop()
+
+    def test_probe(self):
+        self.assertTrue(self.driver.probed.wait(5))
+
+    def test_request_probe(self):
+        self.assertTrue(self.driver.probed.wait(5))
+        self.driver.probe_interval = None
+        self.driver.probed.clear()
+        self.driver.request_probe()
+        self.assertTrue(self.driver.probed.wait(5))
+
+    def test_write(self):
+        self.driver.action_list.set("d", "On", True)
+        self.assertTrue(self.driver.wrote.wait(5))
+        self.assertEqual([("d", "On", True)], self.driver.written)
+
+    def test_batch(self):
+        self.driver.batch_window = 0.05
+        for d in range(10):
+            self.driver.action_list.set(d, "On", True)
+        self.assertTrue(self.driver.wrote.wait(5))
+        self.assertEqual([10], self.driver.flushed)
+
+    def test_write_timeout(self):
+        self.driver.action_list.set("d", "Name", "slow")
+        self.driver.action_list.set("d", "On", True)
+        self.assertTrue(self.driver.wrote.wait(5))
+        self.assertEqual([("d", "On", True)], self.driver.written)
+
+    def test_stop(self):
+        self.driver.stop()
+        self.driver.probed.clear()
+        self.assertFalse(self.driver.probed.wait(0.1))
+
+    def test_stop_tasks(self):
+        done = []
+
+        async def stubborn():
+            # swallows the first cancellation
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                await asyncio.sleep(10)
+            finally:
+                done.append(True)
+
+        async def create():
+            self.driver.create_task(stubborn())
+        self.runtime.submit(create()).result()
+        self.driver.stop()
+        self.assertEqual([True], done)
+        self.assertEqual(set(), self.driver.tasks)
+
+    def test_own_executor(self):
+        other = RecordingDriver(self.runtime)
+        blocked = threading.Event()
+        # all the workers of the driver are blocked
+        for i in range(self.driver.workers):
+            self.runtime.submit(self.driver.call(blocked.wait))
+        try:
+            self.assertEqual(42, self.runtime.submit(
+                other.call(lambda: 42)).result(5))
+        finally:
+            blocked.set()
+            other.stop()
+
+    def test_shared_runtime(self):
+        other = RecordingDriver(self.runtime)
+        other.action_list.set("d", "On", False)
+        self.assertTrue(other.wrote.wait(5))
+        other.stop()
+        self.assertEqual([], self.driver.written)
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+from ble.gatt_cache import GattCache
+import os
+import tempfile
+import threading
+import unittest
+
+MAC = "00:01:02:03:04:05"
+TREE = {"00001815-0000-1000-8000-00805f9b34fb": [
+    "service000a",
+    {"00002a56-0000-1000-8000-00805f9b34fb": "service000a/char000b"}]}
+
+
+class GattCacheTest(unittest.TestCase):
+    """
+    Test setup: an empty cache, saved in a temporary file
+    """
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.filename)
+        self.cache = GattCache(self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_miss(self):
+        self.assertEqual(None, self.cache.get(MAC))
+        self.assertEqual(0, self.cache.generation(MAC))
+
+    def test_put(self):
+        self.cache.put(MAC, TREE)
+        self.assertEqual(TREE, self.cache.get(MAC))
+        self.assertEqual(TREE, GattCache(self.filename).get(MAC))
+
+    def test_invalidate(self):
+        self.cache.put(MAC, TREE)
+        self.cache.invalidate(MAC)
+        self.assertEqual(1, self.cache.generation(MAC))
+        self.assertEqual(None, self.cache.get(MAC))
+        self.assertEqual(None, GattCache(self.filename).get(MAC))
+        self.cache.put(MAC, TREE)
+        self.assertEqual(TREE, GattCache(self.filename).get(MAC))
+        self.assertEqual(1, GattCache(self.filename).generation(MAC))
+
+    def test_concurrent_put(self):
+        errors = []
+
+        def put(i):
+            try:
+                for j in range(50):
+                    self.cache.put("00:00:00:00:{:02}:{:02}".format(i, j),
+                                   TREE)
+                    self.cache.invalidate(MAC)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(200, GattCache(self.filename).generation(MAC))
+        self.assertEqual([], [f for f in os.listdir(
+            os.path.dirname(self.filename)) if f.endswith('.tmp') and
+            f.startswith(os.path.basename(self.filename))])
@@ -0,0 +1,504 @@
+#! /usr/bin/env python
+from coiot.db import CoiotDBInterface
+from coiot.driver import DriverRuntime
+from driver.player.sonos import SonosDriver, SonosDevice, SonosPlayer, \
+    PooledRequests
+from unittest.mock import Mock, patch
+import asyncio
+import requests
+import soco.config
+import soco.exceptions
+import soco.services
+import threading
+import time
+import unittest
+
+
+class StandInSubscription:
+    def __init__(self, service, event_queue):
+        self.service = service
+        self.events = event_queue
+        self.is_subscribed = True
+
+    def unsubscribe(self):
+        self.is_subscribed = False
+
+
+class StandInService:
+    """
+    UPnP service of the stand-in player, sending the events to its
+    subscriptions as soco would
+    """
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, auto_renew=False, event_queue=None):
+        sub = StandInSubscription(self, event_queue)
+        self.subscriptions.append(sub)
+        return sub
+
+    def notify(self, **variables):
+        for sub in self.subscriptions:
+            if sub.is_subscribed:
+                sub.events.put(Mock(variables=variables))
+
+
+class StandInQueue(list):
+    def __init__(self, items, total_matches, update_id):
+        super().__init__(items)
+        self.total_matches = total_matches
+        self.update_id = update_id
+
+
+class StandInAVTransport(StandInService):
+    """
+    Queue edition actions of the stand-in player
+    """
+    def __init__(self, phy):
+        super().__init__()
+        self.phy = phy
+
+    def edit(self, args):
+        """
+        Checks the UpdateID of the edit as the player does
+        """
+        self.phy.request()
+        if args['UpdateID'] not in (0, self.phy.update_id):
+            raise soco.exceptions.SoCoUPnPException(
+                "Invalid UpdateID", '800', "")
+
+    def RemoveTrackRangeFromQueue(self, args):
+        args = dict(args)
+        self.edit(args)
+        start = args['StartingIndex'] - 1
+        del self.phy.tracks[start:start + args['NumberOfTracks']]
+        self.phy.update_id += 1
+        return {'NewUpdateID': str(self.phy.update_id)}
+
+    def AddMultipleURIsToQueue(self, args):
+        args = dict(args)
+        self.edit(args)
+        uris = args['EnqueuedURIs'].split(" ")
+        assert len(uris) == args['NumberOfURIs']
+        position = args['DesiredFirstTrackNumberEnqueued']
+        if position == 0:
+            position = len(self.phy.tracks) + 1
+        self.phy.tracks[position - 1:position - 1] = uris
+        self.phy.update_id += 1
+        return {'NewUpdateID': str(self.phy.update_id)}
+
+
+class StandInPlayer:
+    """
+    Local stand-in of a Sonos player, counting the HTTP requests
+    """
+    def __init__(self, name):
+        self.player_name = name
+        self.avTransport = StandInAVTransport(self)
+        self.renderingControl = StandInService()
+        self.queueService = StandInService()
+        self.requests = 0
+        self.position = '0:00:42'
+        self.playing = False
+        self.reachable = True
+        # set to answer, unless None
+        self.answer = None
+        self.tracks = []
+        self.update_id = 0
+
+    def request(self):
+        if self.answer is not None:
+            self.answer.wait()
+        if not self.reachable:
+            raise requests.exceptions.ConnectionError("unreachable")
+        self.requests += 1
+
+    def get_current_transport_info(self):
+        self.request()
+        return {'current_transport_state': 'STOPPED'}
+
+    def get_current_track_info(self):
+        self.request()
+        return {'duration': '0:03:00', 'position': self.position, 'uri': ''}
+
+    @property
+    def volume(self):
+        self.request()
+        return 10
+
+    def seek(self, hms):
+        self.request()
+        self.position = hms
+
+    def play(self):
+        self.request()
+        self.playing = True
+
+    def get_queue(self, start=0, max_items=100):
+        self.request()
+        items = [Mock(resources=[Mock(uri=uri)])
+                 for uri in self.tracks[start:start + max_items]]
+        return StandInQueue(items, len(self.tracks), self.update_id)
+
+    def clear_queue(self):
+        self.request()
+        self.tracks = []
+        self.update_id += 1
+
+    def play_from_queue(self, index):
+        self.request()
+        self.playing = True
+
+    @property
+    def queue_size(self):
+        self.request()
+        return len(self.tracks)
+
+
+class SonosTest(unittest.TestCase):
+    """
+    Test setup: a driver with a single stand-in player, subscribed to its
+    events
+    """
+    def setUp(self):
+        self.phy = StandInPlayer("Kitchen")
+        queue_service = patch('soco.services.Queue',
+                              lambda phy: phy.queueService)
+        queue_service.start()
+        self.addCleanup(queue_service.stop)
+        self.runtime = DriverRuntime()
+        self.driver = SonosDriver(None, autostart=False,
+                                  runtime=self.runtime)
+        self.assertEqual(["Kitchen"], self.discover(self.phy))
+        self.player = self.driver.devices["Kitchen"]
+        self.player.cache = Mock()
+        self.driver.refresh()
+
+    def tearDown(self):
+        self.driver.stop()
+        self.runtime.stop()
+        CoiotDBInterface.undeclare(SonosDevice)
+        SonosDriver.instance = None
+
+    def discover(self, *players):
+        with patch('soco.discover', return_value=set(players)):
+            return self.driver.discover()
+
+    def sync(self):
+        """
+        Waits until the events already sent are handled
+        """
+        self.runtime.submit(asyncio.sleep(0)).result()
+
+    def wait(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_subscribed(self):
+        self.assertTrue(self.player.subscribed)
+        self.assertEqual(1, len(self.phy.avTransport.subscriptions))
+        self.assertEqual(1, len(self.phy.renderingControl.subscriptions))
+        self.assertEqual(1, len(self.phy.queueService.subscriptions))
+        self.driver.refresh()
+        self.assertEqual(1, len(self.phy.avTransport.subscriptions))
+
+    def test_transport_event(self):
+        self.phy.avTransport.notify(transport_state='PLAYING',
+                                    current_track_uri='x-file:song.mp3',
+                                    current_track_duration='0:03:00')
+        self.assertTrue(self.wait(lambda: self.player.cache.Playing is True))
+        self.assertEqual('x-file:song.mp3', self.player.cache.CurrentSong)
+        self.assertEqual(180, self.player.cache.SongDuration)
+        self.assertTrue(self.wait(
+            lambda: self.player.cache.CurrentTime == 42))
+        # the position task is kept until done
+        self.assertTrue(self.wait(lambda: not self.driver.tasks))
+
+        requests = self.phy.requests
+        self.assertEqual(True, self.player.Playing)
+        self.assertEqual('x-file:song.mp3', self.player.CurrentSong)
+        self.assertEqual(180, self.player.SongDuration)
+        self.assertLessEqual(42, self.player.CurrentTime)
+        self.assertEqual(requests, self.phy.requests)
+
+    def test_volume_event(self):
+        self.phy.renderingControl.notify(volume={'Master': '25', 'LF': '100',
+                                                 'RF': '100'})
+        self.assertTrue(self.wait(lambda: self.player.cache.Volume == 0.25))
+        self.assertEqual(0, self.phy.requests)
+
+    def test_unsubscribed(self):
+        self.phy.avTransport.subscriptions[0].is_subscribed = False
+        self.assertFalse(self.player.subscribed)
+        self.driver.refresh()
+        self.assertTrue(self.player.subscribed)
+        self.assertEqual(2, len(self.phy.avTransport.subscriptions))
+
+    def test_stop(self):
+        self.driver.stop()
+        self.assertFalse(self.phy.avTransport.subscriptions[0].is_subscribed)
+
+    def test_soco_settings(self):
+        settings = soco.config.REQUEST_TIMEOUT, soco.services.requests
+        with patch('soco.discover', return_value={self.phy}):
+            self.driver.start()
+            self.assertIsInstance(soco.services.requests, PooledRequests)
+            self.assertEqual(SonosDriver.request_timeout,
+                             soco.config.REQUEST_TIMEOUT)
+            self.driver.stop()
+        self.assertEqual(settings,
+                         (soco.config.REQUEST_TIMEOUT, soco.services.requests))
+
+    def test_snapshot(self):
+        self.player.unsubscribe()
+        self.assertEqual(180, self.player.SongDuration)
+        self.assertEqual(42, self.player.CurrentTime)
+        self.assertEqual('', self.player.CurrentSong)
+        self.assertEqual(False, self.player.Playing)
+        self.assertEqual(2, self.phy.requests)
+
+        self.player.CurrentTime = 60
+        self.assertEqual(60, self.player.CurrentTime)
+        self.assertEqual(4, self.phy.requests)
+
+    def test_snapshot_write(self):
+        self.player.unsubscribe()
+        fetch = self.phy.get_current_track_info
+
+        def seek_meanwhile():
+            cti = fetch()
+            self.player.CurrentTime = 60
+            return cti
+
+        with patch.object(self.phy, 'get_current_track_info', seek_meanwhile):
+            self.assertEqual(42, self.player.CurrentTime)
+        # the reply predates the seek, it is not kept
+        self.assertEqual(60, self.player.CurrentTime)
+
+    def test_discovery(self):
+        self.assertEqual([], SonosDevice.autodetect())
+        office = StandInPlayer("Office")
+        self.assertEqual(["Office"], self.discover(self.phy, office))
+        self.assertEqual(["Office"], SonosDevice.autodetect())
+        self.driver.refresh()
+        self.assertEqual(1, len(office.avTransport.subscriptions))
+
+        # lost after two discoveries without it
+        self.assertEqual([], self.discover(self.phy))
+        self.assertTrue("Office" in self.driver.devices)
+        self.discover(self.phy)
+        self.assertFalse("Office" in self.driver.devices)
+        self.assertFalse(office.avTransport.subscriptions[0].is_subscribed)
+
+    def test_lost(self):
+        self.discover()
+        self.discover()
+        self.assertTrue(self.player.lost)
+        self.assertEqual(False, self.player.cache.Online)
+        self.assertFalse(self.player.subscribed)
+        self.driver.refresh()
+        self.assertFalse(self.player.subscribed)
+
+        self.discover(self.phy)
+        self.assertEqual(True, self.player.cache.Online)
+        self.driver.refresh()
+        self.assertTrue(self.player.subscribed)
+
+    def test_background_discovery(self):
+        office = StandInPlayer("Office")
+        discovered = []
+        self.driver.on_discovery = lambda: discovered.append(
+            SonosDevice.autodetect())
+        with patch('soco.discover', return_value={self.phy, office}):
+            self.driver.start()
+            self.assertTrue(self.wait(lambda: discovered))
+        self.assertEqual([["Office"]], discovered)
+
+    def play(self, zone):
+        self.runtime.submit(self.driver.write(Mock(Zone=zone), 'Playing',
+                                              True)).result()
+
+    def test_concurrent_players(self):
+        office = StandInPlayer("Office")
+        self.discover(self.phy, office)
+        self.driver.devices["Office"].cache = Mock()
+        self.phy.answer = threading.Event()
+        self.play("Kitchen")
+        self.play("Office")
+        self.assertTrue(self.wait(lambda: office.playing))
+        self.assertFalse(self.phy.playing)
+        self.phy.answer.set()
+        self.assertTrue(self.wait(lambda: self.player.cache.Playing is True))
+
+    def write(self, zone, k, v):
+        self.runtime.submit(self.driver.write(Mock(Zone=zone), k, v)).result()
+
+    def done(self):
+        """
+        Waits until the commands are done
+        """
+        self.assertTrue(self.wait(lambda: not self.driver.tasks))
+
+    def test_command_timeout(self):
+        self.driver.timeout = 0.1
+        self.phy.answer = threading.Event()
+        self.write("Kitchen", 'Playing', True)
+        self.write("Kitchen", 'CurrentTime', 60)
+        time.sleep(0.2)
+        self.phy.answer.set()
+        self.done()
+        # the seek could not start in time: it is neither done nor cached
+        self.assertTrue(self.phy.playing)
+        self.assertIs(True, self.player.cache.Playing)
+        self.assertEqual('0:00:42', self.phy.position)
+        self.assertNotEqual(60, self.player.cache.CurrentTime)
+
+    def test_pending_commands(self):
+        self.phy.answer = threading.Event()
+        for i in range(SonosPlayer.MAX_PENDING + 2):
+            self.write("Kitchen", 'Playing', True)
+        self.phy.answer.set()
+        self.done()
+        self.assertEqual(SonosPlayer.MAX_PENDING, self.phy.requests)
+        self.assertEqual(0, self.player.pending)
+
+    def test_hung_player(self):
+        office = StandInPlayer("Office")
+        self.discover(self.phy, office)
+        self.driver.devices["Office"].cache = Mock()
+        self.phy.answer = threading.Event()
+        self.addCleanup(self.phy.answer.set)
+        with patch('soco.discover', return_value={self.phy, office}):
+            self.driver.start()
+            self.driver.action_list.set(Mock(Zone="Kitchen"), 'Playing',
+                                        True)
+            self.assertTrue(self.wait(lambda: self.player.pending))
+            # the next batch is not delayed by the player not answering
+            self.driver.action_list.set(Mock(Zone="Office"), 'Playing', True)
+            self.assertTrue(self.wait(lambda: office.playing))
+            self.assertFalse(self.phy.playing)
+            self.phy.answer.set()
+            self.assertTrue(self.wait(lambda: self.phy.playing))
+            self.driver.stop()
+
+    def test_breaker(self):
+        self.phy.reachable = False
+        for i in range(SonosPlayer.BREAKER_FAILURES):
+            self.play("Kitchen")
+        self.assertTrue(self.wait(lambda: self.player.cache.Online is False))
+        self.assertFalse(self.player.available)
+
+        self.phy.reachable = True
+        self.play("Kitchen")
+        self.player.worker.submit(lambda: None).result()
+        self.assertFalse(self.phy.playing)
+
+        self.player.open_until = 0
+        self.play("Kitchen")
+        self.assertTrue(self.wait(lambda: self.phy.playing))
+        self.assertTrue(self.wait(lambda: self.player.cache.Online is True))
+        self.assertEqual(0, self.player.failures)
+
+    def test_breaker_probe(self):
+        self.phy.reachable = False
+        for i in range(SonosPlayer.BREAKER_FAILURES):
+            self.assertRaises(OSError, self.player.request, self.phy.play)
+        self.phy.reachable = True
+        self.player.open_until = 0
+        self.phy.answer = threading.Event()
+        probe = threading.Thread(target=self.player.request,
+                                 args=(self.phy.play,), daemon=True)
+        probe.start()
+        self.assertTrue(self.wait(lambda: self.player.probing))
+        # a single request is let through until the probe is answered
+        self.assertFalse(self.player.available)
+        self.assertRaises(ConnectionError, self.player.request,
+                          self.phy.seek, '0:01:00')
+        self.phy.answer.set()
+        probe.join()
+        self.assertTrue(self.player.available)
+        self.assertTrue(self.wait(lambda: self.player.cache.Online is True))
+
+    def test_breaker_nested(self):
+        self.phy.reachable = False
+        for i in range(SonosPlayer.BREAKER_FAILURES):
+            self.assertRaises(OSError, self.player.request, self.phy.play)
+        self.phy.reachable = True
+        self.player.open_until = 0
+        # the setter requests are part of the probe
+        self.write("Kitchen", 'CurrentSong', "x-file:song.mp3")
+        self.done()
+        self.assertEqual(["x-file:song.mp3"], self.phy.tracks)
+        self.assertEqual(0, self.player.failures)
+        self.assertTrue(self.player.available)
+
+    def fill_queue(self, n):
+        self.phy.tracks = ["x-file:{}.mp3".format(i) for i in range(n)]
+        self.phy.avTransport.notify(current_track='1',
+                                    number_of_tracks=str(n))
+        self.assertTrue(self.wait(
+            lambda: self.player.state.get('number_of_tracks') == n))
+
+    def test_next_song(self):
+        self.fill_queue(250)
+        self.player.NextSong = "x-file:next.mp3"
+        self.assertEqual(["x-file:0.mp3", "x-file:next.mp3"], self.phy.tracks)
+        self.assertEqual(2, self.phy.requests)
+
+        self.player.unsubscribe()
+        self.player.NextSong = "x-file:other.mp3"
+        self.assertEqual(["x-file:0.mp3", "x-file:other.mp3"],
+                         self.phy.tracks)
+        self.assertEqual(5, self.phy.requests)
+
+    def test_queue_mirror(self):
+        self.fill_queue(150)
+        self.assertEqual(self.phy.tracks, self.player.get_queue())
+        self.assertEqual(2, self.phy.requests)
+        self.assertEqual("x-file:1.mp3", self.player.NextSong)
+
+        self.player.replace_queue(10, 20, ["x-file:a.mp3", "x-file:b.mp3"])
+        self.player.add_to_queue(["x-file:{}.mp3".format(i)
+                                  for i in range(40)])
+        self.assertEqual(self.phy.tracks, self.player.get_queue())
+        self.assertEqual(self.phy.update_id, self.player.queue_update_id)
+        self.assertEqual(2 + 1 + 1 + 3, self.phy.requests)
+
+        # our own edit is evented
+        self.phy.queueService.notify(update_id=str(self.phy.update_id))
+        self.sync()
+        self.assertIsNotNone(self.player.queue)
+
+        # the UpdateID of the cleared queue is not known, 0 is sent
+        self.player.CurrentSong = "x-file:song.mp3"
+        self.assertEqual(0, self.player.queue_update_id)
+        self.assertEqual(["x-file:song.mp3"], self.player.get_queue())
+        self.assertEqual(self.phy.tracks, self.player.get_queue())
+
+        # edited by another client
+        self.phy.avTransport.notify(number_of_tracks='3')
+        self.assertTrue(self.wait(lambda: self.player.queue is None))
+
+    def test_queue_edited(self):
+        self.fill_queue(4)
+        self.assertEqual(self.phy.tracks, self.player.get_queue())
+        # reordered by another client, the length is the same
+        self.phy.tracks.reverse()
+        self.phy.update_id += 1
+        self.phy.queueService.notify(update_id=str(self.phy.update_id))
+        self.assertTrue(self.wait(lambda: self.player.queue is None))
+        self.assertEqual(0, self.player.queue_update_id)
+        self.assertEqual("x-file:2.mp3", self.player.NextSong)
+
+        # an edit of another client not evented yet is rejected
+        self.assertEqual(self.phy.tracks, self.player.get_queue())
+        self.phy.update_id += 1
+        with self.assertRaises(soco.exceptions.SoCoUPnPException):
+            self.player.NextSong = "x-file:next.mp3"
+
+        self.player.unsubscribe()
+        self.assertEqual(0, self.player.queue_update_id)
+        self.player.NextSong = "x-file:next.mp3"
+        self.assertEqual(["x-file:3.mp3", "x-file:next.mp3"], self.phy.tracks)